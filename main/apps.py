@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class MainConfig(AppConfig):
     name = 'main'
+
+    def ready(self):
+        from main.sqlite import configure_connection
+        connection_created.connect(configure_connection)
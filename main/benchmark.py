@@ -0,0 +1,237 @@
+"""
+Synthetic ledgers and timings of the key operations, used by the benchmark command.
+"""
+import io
+import math
+import random
+import subprocess
+import time
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import Client
+
+from main.billing import BillingPeriod
+from main.instrumentation import QueryCounter
+from main.models import Consumption, ConsumptionRollup, CumulativeOrder, IncomingInvoice, Inventory, \
+    Order, OutgoingInvoice, Product, ProductInventory, ProductType, UserExtension, inventory_index
+
+# bottles per crate, orders are rounded up to full crates
+CRATE = 24
+
+
+class LedgerGenerator(object):
+    """
+    Generates a ledger of monthly inventories with orders restocking the consumed products.
+
+    Few users and products account for most of the consumptions, as in a real tally.
+    """
+
+    def __init__(self, users=30, products=20, years=3, consumptions=100000, seed=0, start=date(2016, 1, 1)):
+        """
+        :param consumptions: total number of consumption rows
+        """
+        self.users = users
+        self.products = products
+        self.years = years
+        self.consumptions = consumptions
+        self.start = start
+        self._random = random.Random(seed)
+
+    def _inventory_dates(self):
+        dates = [self.start]
+        for month in range(1, self.years * 12 + 1):
+            year, month = divmod(self.start.month - 1 + month, 12)
+            dates.append(self.start.replace(year=self.start.year + year, month=month + 1))
+        return dates
+
+    def _create_users(self):
+        User.objects.bulk_create([User(username="user%04d" % i) for i in range(self.users)])
+        users = list(User.objects.filter(username__startswith="user").order_by("pk"))
+        UserExtension.objects.bulk_create([UserExtension(user=user) for user in users])
+        return users
+
+    def _create_products(self):
+        product_types = [ProductType.objects.create(name=name) for name in ["Beer", "Soft Drinks", "Snacks"]]
+        Product.objects.bulk_create([Product(name="Product %03d" % i, product_type=product_types[i % 3])
+                                     for i in range(self.products)])
+        return list(Product.objects.order_by("pk"))
+
+    def _consumptions(self, begin, end, count, users, products, user_weights, product_weights, issued_by):
+        days = (end - begin).days - 1
+        for user, product in zip(self._random.choices(users, user_weights, k=count),
+                                 self._random.choices(products, product_weights, k=count)):
+            yield Consumption(user=user, product=product, issued_by=issued_by,
+                              count=self._random.choice([1, 1, 1, 1, 2, 3]),
+                              date=begin + timedelta(days=self._random.randint(1, days)))
+
+    @transaction.atomic
+    def generate(self, issued_by):
+        """
+        Write the ledger, bypassing the per row bookkeeping, and rebuild the derived tables afterwards.
+
+        :param issued_by: user the consumptions are issued by
+        :return: list of created inventories, ordered by date
+        """
+        users = self._create_users()
+        products = self._create_products()
+        user_weights = [1. / (i + 1) for i in range(len(users))]
+        product_weights = [1. / (i + 1) for i in range(len(products))]
+        prices = dict((product.pk, self._random.randint(40, 150)) for product in products)
+        stock = dict((product.pk, 0) for product in products)
+
+        dates = self._inventory_dates()
+        per_period = int(math.ceil(self.consumptions / float(len(dates) - 1)))
+        Inventory.objects.bulk_create([Inventory(date=d) for d in dates])
+        inventory_index.changed()
+        inventories = list(Inventory.objects.filter(date__in=dates).order_by("date"))
+        ProductInventory.objects.bulk_create([ProductInventory(inventory=inventories[0], product=product, count=0)
+                                              for product in products])
+        for begin, end, inventory in zip(dates, dates[1:], inventories[1:]):
+            consumptions = list(self._consumptions(begin, end, per_period, users, products, user_weights,
+                                                   product_weights, issued_by))
+            consumed = dict((product.pk, 0) for product in products)
+            for consumption in consumptions:
+                consumed[consumption.product_id] += consumption.count
+
+            # restock at the beginning of the period, with a buffer of 10%
+            incoming_invoice = IncomingInvoice.objects.create(invoice_id="R%s" % begin, date=begin + timedelta(days=1))
+            orders = []
+            for product in products:
+                missing = int(consumed[product.pk] * 1.1) - stock[product.pk]
+                if missing > 0:
+                    count = int(math.ceil(missing / float(CRATE))) * CRATE
+                    prices[product.pk] += self._random.choice([-1, 0, 0, 1])
+                    orders.append(Order(incoming_invoice=incoming_invoice, product=product, count=count,
+                                        each_cents=prices[product.pk]))
+                    stock[product.pk] += count
+            Order.objects.bulk_create(orders)
+            Consumption.objects.bulk_create(consumptions)
+
+            inventory_counts = []
+            for product in products:
+                # a few bottles get lost
+                loss = self._random.randint(0, int(consumed[product.pk] * 0.02))
+                stock[product.pk] -= consumed[product.pk] + loss
+                inventory_counts.append(ProductInventory(inventory=inventory, product=product, count=stock[product.pk]))
+            ProductInventory.objects.bulk_create(inventory_counts)
+
+        CumulativeOrder.rebuild()
+        ConsumptionRollup.rebuild()
+        return inventories
+
+
+def measure(operation):
+    """
+    Run the operation once, its output is discarded.
+
+    :return: OrderedDict with wall time, number of queries and time spent in queries
+    """
+    counter = QueryCounter()
+    begin = time.monotonic()
+    with connection.execute_wrapper(counter), redirect_stdout(io.StringIO()):
+        operation()
+    return OrderedDict([("seconds", time.monotonic() - begin), ("queries", counter.count),
+                        ("query_seconds", counter.seconds)])
+
+
+def measure_construction(model, count):
+    """
+    Construct instances from database rows fetched beforehand, like a queryset does when it is evaluated.
+
+    :param count: maximum number of rows
+    :return: OrderedDict with number of instances, microseconds per instance and queries issued while constructing
+    """
+    field_names = [field.attname for field in model._meta.concrete_fields]
+    rows = list(model._base_manager.values_list(*field_names)[:count])
+    result = measure(lambda: [model.from_db(connection.alias, field_names, row) for row in rows])
+    return OrderedDict([("instances", len(rows)),
+                        ("microseconds", result["seconds"] * 1e6 / len(rows) if rows else 0.),
+                        ("queries", result["queries"])])
+
+
+def _get(client, path):
+    def get():
+        response = client.get(path)
+        assert response.status_code == 200, "%s: %d" % (path, response.status_code)
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+    return get
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=settings.BASE_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(generator, repeat=3):
+    """
+    Generate a ledger into the default database and time the key operations on it.
+
+    Read only operations run repeat times, the fastest run is reported.
+
+    :return: report as a dict of json serializable values
+    """
+    admin = User.objects.create(username="benchmark", is_staff=True, is_superuser=True)
+    report = OrderedDict([
+        ("commit", git_commit()),
+        ("date", datetime.now().isoformat()),
+        ("debug", settings.DEBUG),
+        ("parameters", OrderedDict([("users", generator.users), ("products", generator.products),
+                                    ("years", generator.years), ("consumptions", generator.consumptions)])),
+        ("operations", OrderedDict()),
+    ])
+    operations = report["operations"]
+
+    inventories = []
+    operations["generate"] = measure(lambda: inventories.extend(generator.generate(admin)))
+    operations["calculate --all"] = measure(lambda: call_command("calculate", all=True))
+
+    # approve all invoices but the latest and change an approved period, like a late tally
+    latest = inventories[-1]
+    OutgoingInvoice.objects_all.exclude(inventory=latest).update(is_frozen=True)
+    corrected = inventories[len(inventories) // 2]
+    Consumption.objects.create(user=admin, product=Product.objects.first(), count=1, issued_by=admin,
+                               date=corrected.date - timedelta(days=1))
+    operations["recalculate_temporary_invoices"] = measure(
+        lambda: BillingPeriod(corrected).recalculate_temporary_invoices())
+    operations["recalculate_temporary_invoices full"] = measure(
+        lambda: BillingPeriod(latest).recalculate_temporary_invoices(full=True))
+
+    client = Client(HTTP_HOST=settings.ALLOWED_HOSTS[0])
+    client.force_login(admin)
+    user_client = Client(HTTP_HOST=settings.ALLOWED_HOSTS[0])
+    # the heaviest consumer
+    user_client.force_login(User.objects.get(username="user0000"))
+    views = [
+        ("admin_inventory_list", client, "/inventories/"),
+        ("admin_invoice_detailed", client, "/invoice/%s/" % corrected.date.strftime("%Y-%m-%d")),
+        ("user_consumptions", user_client, "/consumptions/"),
+        ("user_invoices", user_client, "/user_invoices/"),
+        ("schwund_charts", user_client, "/charts/"),
+        ("csv export", client, "/invoice_csv/"),
+    ]
+    for name, view_client, path in views:
+        operations[name] = min((measure(_get(view_client, path)) for _ in range(repeat)),
+                               key=lambda result: result["seconds"])
+
+    report["construction"] = OrderedDict(
+        (model.__name__, measure_construction(model, generator.consumptions))
+        for model in [Consumption, ProductInventory, Order, Inventory, OutgoingInvoice])
+
+    report["ledger"] = OrderedDict([
+        ("inventories", Inventory.objects.count()),
+        ("orders", Order.objects.count()),
+        ("consumptions", Consumption.objects.count()),
+        ("invoices", OutgoingInvoice.objects_all.count()),
+    ])
+    return report
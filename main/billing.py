@@ -1,12 +1,12 @@
 import csv
 import math
+import multiprocessing
 import time
 import traceback
+from collections import defaultdict
 from datetime import datetime
-from sqlite3 import OperationalError
 
 from django.db import transaction, OperationalError
-from django.db.backends import sqlite3
 from django.db.models import F
 from django.db.models.aggregates import Sum
 from django.db.models.query_utils import Q
@@ -14,9 +14,14 @@ from threading import Thread
 
 import numpy
 
-from main.models import Consumption, Order, Inventory, Product, OutgoingInvoice, \
-    OutgoingInvoiceProductPosition, OutgoingInvoiceProductUserPosition, ProductInventory
-from tallybill.tally_settings import PROFIT_FACTOR, PROFIT_FIXED_CENTS
+from main.instrumentation import instrument
+from main.ledger import PeriodLedger, IdIndex, OrderColumns, date_buckets, fifo_cost, fill_table, real_consumption_table
+from main.notify import ListenerRunning, RecalculationListener
+from main.models import ConsumptionRollup, Order, Inventory, Product, OutgoingInvoice, \
+    OutgoingInvoiceProductPosition, OutgoingInvoiceProductUserPosition, ProductInventory, DirtyProduct, \
+    CumulativeOrder
+from tallybill.tally_settings import RECALCULATE_IDLE_SECONDS, RECALCULATE_ATTEMPTS, RECALCULATE_RETRY_SECONDS, \
+    STATEMENT_PAGE_INVOICES
 
 
 def _get_total_consumption_until(product, date):
@@ -26,9 +31,22 @@ def _get_total_consumption_until(product, date):
         inventory_count = ProductInventory.objects.get(inventory__date=date, product=product).count
     except ProductInventory.DoesNotExist as e:
         pass
-    orders_until = (Order.objects.filter(product=product, incoming_invoice__date__lte=date)
-                    .aggregate(Sum("count"))["count__sum"] or 0)
-    return orders_until - inventory_count
+    return CumulativeOrder.ordered_until(product, date) - inventory_count
+
+
+def create_positions(invoice, positions):
+    # write all positions of an invoice with one insert batch per table
+    OutgoingInvoiceProductPosition.objects.bulk_create([
+        OutgoingInvoiceProductPosition(product_id=product.product_id, invoice=invoice, loss=product.loss,
+                                       price_each=product.price_each, total=product.total, profit=product.profit)
+        for product in positions])
+    # bulk_create does not return primary keys on sqlite, but products are unique per invoice
+    position_ids = dict(OutgoingInvoiceProductPosition.objects.filter(
+        invoice=invoice, product_id__in=[product.product_id for product in positions])
+        .values_list("product_id", "pk"))
+    OutgoingInvoiceProductUserPosition.objects.bulk_create([
+        OutgoingInvoiceProductUserPosition(user_id=user, count=count, productinvoice_id=position_ids[product.product_id])
+        for product in positions for user, count in product.user_counts])
 
 
 class BillingPeriod(object):
@@ -38,14 +56,16 @@ class BillingPeriod(object):
         self._inventory = inventory
         self._previous_inventory = previous_inventory
         if inventory is not None and previous_inventory is None:
-            previous_inventories = Inventory.objects.filter(date__lt=inventory.date).order_by("-date")
-            if previous_inventories.count() > 0:
-                self._previous_inventory = previous_inventories.first()
+            self._previous_inventory = Inventory.get_prev_inventory_by_date(inventory.date)
 
     @property
     def inventory(self):
         return self._inventory
 
+    @property
+    def previous_inventory(self):
+        return self._previous_inventory
+
     @property
     def products(self):
         query = Q(productinventory__inventory=self._inventory)
@@ -78,53 +98,146 @@ class BillingPeriod(object):
     def invoices(self):
         return OutgoingInvoice.objects_all.filter(inventory=self._inventory).order_by("date")
 
-    @transaction.atomic
-    def recalculate_temporary_invoices(self):
+    def get_temporary_invoice(self):
         # there should always only be one temporary invoice
         try:
-            invoice = self.invoices.get(is_frozen=False)
+            return self.invoices.get(is_frozen=False)
         except OutgoingInvoice.DoesNotExist:
+            return None
+
+    def _compute_positions(self, full):
+        # read everything in one transaction to compute the positions from a consistent snapshot
+        with transaction.atomic():
+            changes = list(self._inventory.dirtyproduct_set.values_list("pk", "product_id"))
+            # without recorded changes or with a change affecting the whole period everything is recalculated
+            product_ids = None
+            if (not full and changes and all(product_id is not None for _, product_id in changes) and
+                    self.get_temporary_invoice() is not None):
+                product_ids = set(product_id for _, product_id in changes)
+            positions = PeriodLedger.load(self._inventory, self._previous_inventory, product_ids).positions()
+        return positions, product_ids, [pk for pk, _ in changes]
+
+    def recalculate_temporary_invoices(self, full=False):
+        """
+        Positions are computed without holding the write lock, only writing them takes a short transaction.
+
+        If the ledger of the period changed in the meantime (new dirty markers) or the database is locked,
+        the recalculation is repeated a few times.
+
+        :param full: recalculate all positions instead of only those of products marked as dirty
+        :return: False if the period kept changing, it stays marked as changed in that case
+        """
+        for attempt in range(RECALCULATE_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(RECALCULATE_RETRY_SECONDS * 2 ** (attempt - 1))
+            positions, product_ids, change_ids = self._compute_positions(full)
+            try:
+                with transaction.atomic():
+                    changed = (self._inventory.dirtyproduct_set.exclude(pk__in=change_ids).exists() or
+                               (product_ids is not None and self.get_temporary_invoice() is None))
+                    if not changed:
+                        self.write_positions(positions, product_ids, change_ids)
+                        return True
+            except OperationalError:
+                if attempt == RECALCULATE_ATTEMPTS - 1:
+                    raise
+        return False
+
+    @transaction.atomic
+    def write_positions(self, positions, product_ids=None, change_ids=()):
+        """
+        Replace positions of the temporary invoice by recalculated ones.
+
+        :param positions: list of ProductPosition
+        :param product_ids: products the positions were recalculated for, None for all products
+        :param change_ids: ids of the DirtyProduct markers the recalculation took into account
+        """
+        invoice = self.get_temporary_invoice()
+        if invoice is None:
+            assert product_ids is None, "a new temporary invoice needs all positions"
             try:
                 correction_of = self._inventory.outgoinginvoice_set.get()
             except OutgoingInvoice.DoesNotExist:
                 correction_of = None
             invoice = OutgoingInvoice(inventory=self._inventory, correction_of=correction_of)
             invoice.save()
-        invoice.outgoinginvoiceproductposition_set.all().delete()
-
-        # recalculate shit
-        invoice_total = 0
-        invoice_profit = 0
-        for product in self.products:
-            pos_loss_factor = float(max(1.0, product.get_loss_factor()))
-            avg_price = product.get_avg_price_for_consumed()
-            if pos_loss_factor == math.inf:
-                each_cents = 0
-                each_no_profit = 0
-            else:
-                each_cents = int(avg_price * pos_loss_factor * PROFIT_FACTOR + PROFIT_FIXED_CENTS)
-                each_no_profit = int(avg_price * pos_loss_factor)
-
-            position = OutgoingInvoiceProductPosition.objects.create(
-                product=product.product, invoice=invoice,
-                loss=product.get_loss(), price_each=each_cents, total=0, profit=0)
-            product_total = 0
-            for user, count in product.get_user_consumptions():
-                product_total += count
-                OutgoingInvoiceProductUserPosition.objects.create(user_id=user, count=count, productinvoice=position)
-            invoice_total += product_total * each_cents
-            invoice_profit += product_total * each_cents - product_total * each_no_profit
-            position.total = product_total * each_cents
-            position.profit = product_total * each_cents - product_total * each_no_profit
-            position.save()
-
-        invoice.total = invoice_total
-        invoice.profit = invoice_profit
+        outdated_positions = invoice.outgoinginvoiceproductposition_set.all()
+        if product_ids is not None:
+            outdated_positions = outdated_positions.filter(product_id__in=product_ids)
+        outdated_positions.delete()
+        create_positions(invoice, positions)
+
+        totals = invoice.outgoinginvoiceproductposition_set.aggregate(Sum("total"), Sum("profit"))
+        invoice.total = totals["total__sum"] or 0
+        invoice.profit = totals["profit__sum"] or 0
+        invoice.version += 1
         invoice.save()
-        self._inventory.may_have_changed = False
+        DirtyProduct.objects.filter(pk__in=change_ids).delete()
+        # changes recorded meanwhile are left for the next recalculation
+        self._inventory.may_have_changed = self._inventory.dirtyproduct_set.exists()
         self._inventory.save(fast=True)
 
 
+# ledger columns shared with the worker processes of recalculate_all
+_snapshot_orders = None
+
+
+def _init_snapshot(orders):
+    global _snapshot_orders
+    _snapshot_orders = orders
+
+
+def _compute_positions(period):
+    # runs in a worker process, must not access the database
+    inventory, previous_inventory, inventory_rows, consumption_rows = period
+    return PeriodLedger.from_rows(inventory, previous_inventory, None, inventory_rows, _snapshot_orders,
+                                  consumption_rows).positions()
+
+
+def recalculate_all(inventories, processes=None):
+    """
+    Recalculate the temporary invoices of the inventories' periods in parallel.
+
+    The ledger is read once, periods are computed by a pool of worker processes and all positions are written
+    in a single transaction afterwards.
+
+    :param processes: number of worker processes, defaults to the number of cores
+    """
+    with transaction.atomic():
+        # consistent snapshot of everything the periods depend on
+        all_inventories = list(Inventory.objects.order_by("date"))
+        inventory_ids = set(i.pk for i in inventories)
+        inventory_rows = defaultdict(list)
+        for row in ProductInventory.objects.values_list("inventory_id", "product_id", "count"):
+            inventory_rows[row[0]].append(row)
+        consumption_rows = defaultdict(list)
+        for inventory_id, product_id, user_id, count in (
+                ConsumptionRollup.objects.filter(inventory_id__in=inventory_ids).order_by("product_id", "user_id")
+                .values_list("inventory_id", "product_id", "user_id", "count")):
+            consumption_rows[inventory_id].append((product_id, user_id, count))
+        order_rows = list(CumulativeOrder.objects.order_by("product_id", "pk")
+                          .values_list("product_id", "date", "count", "cents", "each_cents"))
+        change_ids = defaultdict(list)
+        for inventory_id, pk in DirtyProduct.objects.filter(inventory_id__in=inventory_ids).values_list(
+                "inventory_id", "pk"):
+            change_ids[inventory_id].append(pk)
+
+    periods = []
+    for previous, inventory in zip([None] + all_inventories, all_inventories):
+        if inventory.pk in inventory_ids:
+            periods.append((inventory, previous,
+                            inventory_rows[inventory.pk] + (inventory_rows[previous.pk] if previous else []),
+                            consumption_rows[inventory.pk]))
+    # forked workers inherit the configured django apps and the order columns, converted once for all periods
+    orders = OrderColumns(order_rows)
+    with multiprocessing.get_context("fork").Pool(processes, initializer=_init_snapshot, initargs=(orders, )) as pool:
+        positions = pool.map(_compute_positions, periods)
+
+    with transaction.atomic():
+        for (inventory, previous, _, _), period_positions in zip(periods, positions):
+            BillingPeriod(inventory, previous).write_positions(period_positions, None, change_ids[inventory.pk])
+
+
 class ProductInPeriod(object):
 
     def __init__(self, billing_period, product):
@@ -147,72 +260,48 @@ class ProductInPeriod(object):
 
     @staticmethod
     def get_total_orders_table(inventories_qs, product_qs):
-        inventories = inventories_qs.values_list("pk", "date")
-        product_ids = list(product_qs.values_list("pk", flat=True))
-        orders = (Order.objects.values("incoming_invoice__date", "product")
-                  .annotate(count=Sum("count")).order_by("incoming_invoice__date")
-                  .values_list("incoming_invoice__date", "product", "count").iterator())
-        table = numpy.zeros((inventories.count(), Product.objects.count()), dtype=int)
-
-        try:
-            order_date, order_product_id, count = next(orders)
-            for i, (pk, date) in enumerate(inventories):
-                    while order_date <= date:
-                        table[i][product_ids.index(order_product_id)] += count
-                        order_date, order_product_id, count = next(orders)
-        except StopIteration:
-            pass
-        return table
+        # one row per inventory (ascending by date), one column per product
+        inventory_dates = list(inventories_qs.order_by("date").values_list("date", flat=True))
+        products = IdIndex(product_qs.values_list("pk", flat=True))
+        orders = list(Order.objects.values("incoming_invoice__date", "product")
+                      .annotate(count=Sum("count")).order_by("incoming_invoice__date")
+                      .values_list("incoming_invoice__date", "product", "count"))
+        dates, product_ids, counts = zip(*orders) if orders else ([], [], [])
+        return fill_table((len(inventory_dates), len(products)),
+                          date_buckets(dates, inventory_dates), products.offsets(product_ids), counts)
 
     @staticmethod
     def get_product_inventory_count_table(inventories_qs, product_qs):
-        # TODO what if inventories_qs is not all inventories ordered by date... fail
-        inventories = list(inventories_qs.values_list("pk", flat=True))
-        product_ids = list(product_qs.values_list("pk", flat=True))
-        product_inventories = ProductInventory.objects.values_list("inventory", "product", "count")
-        table = numpy.zeros((len(inventories), len(product_ids)), dtype=int)
-
-        for inventory, product, count in product_inventories:
-                table[inventories.index(inventory)][product_ids.index(product)] += count
-        return table, inventories, product_ids
+        # one row per inventory (ascending by date), one column per product
+        # counts of inventories or products not in the querysets are ignored
+        inventories = IdIndex(inventories_qs.order_by("date").values_list("pk", flat=True))
+        products = IdIndex(product_qs.values_list("pk", flat=True))
+        product_inventories = list(ProductInventory.objects.values_list("inventory", "product", "count"))
+        inventory_ids, product_ids, counts = zip(*product_inventories) if product_inventories else ([], [], [])
+        table = fill_table((len(inventories), len(products)),
+                           inventories.offsets(inventory_ids), products.offsets(product_ids), counts)
+        return table, inventories.ids.tolist(), products.ids.tolist()
 
     @classmethod
     def get_real_consumption_list(cls, inventories_qs, product_qs):
-        # TODO what if inventories_qs is not all inventories ordered by date... fail
-        product_inventory_table, inventory_ids, product_ids = cls.get_product_inventory_count_table(inventories_qs, product_qs)
-        product_order_table = cls.get_total_orders_table(inventories_qs, product_qs)
-
-        result_table = numpy.zeros(product_order_table.shape, dtype=int)
-        for inventory_idx in range(len(inventory_ids)):
-            for product_idx in range(len(product_ids)):
-                if inventory_idx > 0:
-                    previous_inventory_count = product_inventory_table[inventory_idx - 1, product_idx]
-                else:
-                    previous_inventory_count = 0
-                result_table[inventory_idx, product_idx] = (previous_inventory_count +
-                                                            product_order_table[inventory_idx, product_idx] -
-                                                            product_inventory_table[inventory_idx, product_idx])
-        return result_table
+        # one row per inventory (ascending by date), one column per product
+        product_inventory_table, _, _ = cls.get_product_inventory_count_table(inventories_qs, product_qs)
+        return real_consumption_table(product_inventory_table, cls.get_total_orders_table(inventories_qs, product_qs))
 
     @staticmethod
-    def get_listed_consumptions_table(inventories_qs, product_qs, consumptions=None):
-        # TODO what if inventories_qs is not all inventories ordered by date... fail
-        inventories = inventories_qs.values_list("pk", "date").order_by("date")
-        product_ids = list(product_qs.values_list("pk", flat=True))
-
-        consumptions_iter = ((Consumption.objects if consumptions is None else consumptions)
-                             .values_list("date", "product_id", "count").order_by("date").iterator())
+    def get_listed_consumptions_table(inventories_qs, product_qs, user=None):
+        inventory_dates = list(inventories_qs.order_by("date").values_list("date", flat=True))
+        products = IdIndex(product_qs.values_list("pk", flat=True))
 
-        table = numpy.zeros((inventories.count(), len(product_ids)), dtype=int)
-        try:
-            consumption_date, product_id, count = next(consumptions_iter)
-            for i, (pk, date) in enumerate(inventories):
-                while consumption_date <= date:
-                    table[i][product_ids.index(product_id)] += count
-                    consumption_date, product_id, count = next(consumptions_iter)
-        except StopIteration:
-            pass
-        return table
+        # consumptions after the last inventory are not part of any period
+        rollup = ConsumptionRollup.objects.filter(inventory__isnull=False)
+        if user is not None:
+            rollup = rollup.filter(user=user)
+        consumptions = list(rollup.values("inventory__date", "product_id").annotate(consumed=Sum("count"))
+                            .order_by().values_list("inventory__date", "product_id", "consumed"))
+        dates, product_ids, counts = zip(*consumptions) if consumptions else ([], [], [])
+        return fill_table((len(inventory_dates), len(products)),
+                          date_buckets(dates, inventory_dates), products.offsets(product_ids), counts)
 
     def get_real_consumption(self):
         assert isinstance(self._billing_period.inventory, Inventory)
@@ -242,9 +331,7 @@ class ProductInPeriod(object):
 
     def get_listed_consumptions(self):
         assert isinstance(self._product, Product)
-        date_from = datetime.min if self._billing_period.date_from is None else self._billing_period.date_from
-        return (self._product.consumption_set.filter(date__gt=date_from,
-                                                     date__lte=self._billing_period.date_until)
+        return (self._product.consumptionrollup_set.filter(inventory_id=self._billing_period.inventory.pk)
                 .aggregate(Sum("count"))["count__sum"] or 0)
 
     def get_avg_price_for_consumed(self):
@@ -256,29 +343,19 @@ class ProductInPeriod(object):
         consumed_before_period = _get_total_consumption_until(self._product, date_from)
 
         real_consumptions = max(self.get_real_consumption(), 0)
-        remaining_consumptions = real_consumptions
 
-        orders = self._product.order_set.order_by("incoming_invoice__date").values_list("count", "each_cents")
-        if orders.count() == 0:
-            quantities, prices = [], []
-        else:
-            quantities, prices = zip(*orders)
-        quantities, prices = list(quantities), list(prices)
-        # filter out all already billed quantities
-        for i in range(len(quantities)):
-            if consumed_before_period > 0:
-                v = min(consumed_before_period, quantities[i])
-                consumed_before_period -= v
-                quantities[i] -= v
-            if consumed_before_period == 0:
-                v = min(quantities[i], remaining_consumptions)
-                quantities[i] = v
-                remaining_consumptions -= v
-
-        assert(sum(quantities) == real_consumptions)
-        if sum(quantities) == 0:
+        orders = list(CumulativeOrder.objects.filter(product=self._product).order_by("pk")
+                      .values_list("count", "cents", "each_cents"))
+        if not orders:
             return 0
-        return sum([quantities[i] * prices[i] for i in range(len(prices))]) / sum(quantities)
+        counts, cents, prices = (numpy.array(c, dtype=numpy.int64) for c in zip(*orders))
+        # skip all already billed quantities
+        skip = min(max(consumed_before_period, 0), counts[-1])
+        until = min(skip + real_consumptions, counts[-1])
+        if until == skip:
+            return 0
+        cost_until, cost_skipped = fifo_cost(counts, cents, prices, [until, skip])
+        return int(cost_until - cost_skipped) / int(until - skip)
 
     def get_loss_factor(self):
         # return factor to compensate loss
@@ -303,76 +380,165 @@ class ProductInPeriod(object):
             return -math.inf
 
     def get_user_consumptions(self, user=None):
-        date_from = datetime.min if self._billing_period.date_from is None else self._billing_period.date_from
-        consumptions = Consumption.objects.filter(date__gt=date_from,
-                                                  date__lte=self._billing_period.date_until, product=self._product)
+        consumptions = ConsumptionRollup.objects.filter(inventory_id=self._billing_period.inventory.pk,
+                                                        product=self._product)
         if user is not None:
             consumptions = consumptions.filter(user=user)
-
-        return (consumptions.values("user").annotate(consumed=Sum("count"))
-                .order_by("user").values_list("user", "consumed"))
+        return consumptions.order_by("user").values_list("user", "count")
 
 
 class RecalculateThread(Thread):
 
     def __init__(self, *args, **kwargs):
         super(RecalculateThread, self).__init__(*args, **kwargs)
-        self.running = True
+        self._listener = RecalculationListener()
+        self._running = True
+
+    @property
+    def running(self):
+        return self._running
+
+    @running.setter
+    def running(self, running):
+        self._running = running
+        if not running:
+            self._listener.wake()
 
     def run(self):
         print("Started Recalculation Thread.")
-        while self.running:
-            try:
-                inventories = Inventory.objects.filter(may_have_changed=True)
-                for inventory in inventories:
-                    print("Recalculating: %s" % str(inventory))
-                    BillingPeriod(inventory).recalculate_temporary_invoices()
-            except OperationalError:
-                pass
-            except:
-                traceback.print_exc()
-            time.sleep(1.0)
+        try:
+            while self.running:
+                try:
+                    inventories = Inventory.objects.filter(may_have_changed=True)
+                    for inventory in inventories:
+                        print("Recalculating: %s" % str(inventory))
+                        with instrument("recalculation", str(inventory.date)):
+                            recalculated = BillingPeriod(inventory).recalculate_temporary_invoices()
+                        if not recalculated:
+                            print("Changed during recalculation, postponed: %s" % str(inventory))
+                except OperationalError:
+                    print("Database locked, recalculation postponed:")
+                    traceback.print_exc()
+                except:
+                    traceback.print_exc()
+                # sleep until a change is notified
+                self._listener.wait(RECALCULATE_IDLE_SECONDS)
+        finally:
+            self._listener.close()
 
         print("End Recalculation Thread.")
 
-def outgoing_to_csv(outgoing, f, difference=False):
+def get_user_statement(user, before=None, count=STATEMENT_PAGE_INVOICES):
+    """
+    Lines billed to a user by the latest frozen invoices, read with a single query.
+
+    :param before: only invoices of periods ending before this date, to page through older invoices
+    :param count: number of invoices, None for all
+    :return: list of (period end date, list of (product name, price each cents, count, loss)), newest first, and
+             the date to pass as before to get the next page (None on the last page)
+    """
+    positions = OutgoingInvoiceProductUserPosition.objects.filter(productinvoice__invoice__is_latest_frozen=True,
+                                                                 user=user)
+    if before is not None:
+        positions = positions.filter(productinvoice__invoice__inventory__date__lt=before)
+    if count is not None:
+        # one more invoice than requested tells whether there is another page
+        dates = (positions.order_by("-productinvoice__invoice__inventory__date")
+                 .values("productinvoice__invoice__inventory__date").distinct()[:count + 1])
+        positions = positions.filter(productinvoice__invoice__inventory__date__in=dates)
+
+    statement = []
+    for invoice_date, name, price_each, position_count, loss in (
+            positions.order_by("-productinvoice__invoice__inventory__date", "productinvoice__product__name")
+            .values_list("productinvoice__invoice__inventory__date", "productinvoice__product__name",
+                         "productinvoice__price_each", "count", "productinvoice__loss")):
+        if not statement or statement[-1][0] != invoice_date:
+            statement.append((invoice_date, []))
+        statement[-1][1].append((name, price_each, position_count, loss))
+    if count is not None and len(statement) > count:
+        return statement[:count], statement[count - 1][0]
+    return statement, None
+
+
+def get_user_sums(invoices):
+    """
+    Amounts billed to every user, of all invoices in a single query.
+
+    :return: dict invoice id -> dict user id -> (username, total cents)
+    """
+    user_sums = dict((invoice.pk, {}) for invoice in invoices)
+    for invoice_id, user_id, username, total in (
+            OutgoingInvoiceProductUserPosition.objects.filter(productinvoice__invoice__in=list(user_sums))
+            .values_list("productinvoice__invoice_id", "user__pk", "user__username")
+            .annotate(total=Sum(F("count") * F("productinvoice__price_each")))
+            .order_by("productinvoice__invoice_id", "user__username")):
+        user_sums[invoice_id][user_id] = (username, total)
+    return user_sums
+
+
+def outgoing_csv_rows(outgoing, user_sums, difference=False):
+    """
+    :param user_sums: user sums (see get_user_sums) of the invoice and, if difference, the invoice it corrects
+    :return: generator of csv rows of the invoice
+    """
+    current_positions = user_sums[outgoing.pk]
+    if outgoing.correction_of_id is not None and difference:
+        previous_positions = user_sums[outgoing.correction_of_id]
+    else:
+        previous_positions = {}
+
+    updated_positions = [((current_positions[k][0], current_positions[k][1] - previous_positions[k][1])
+                          if k in previous_positions else current_positions[k])
+                         for k in current_positions]
+    removed_positions = [(previous_positions[k][0], -previous_positions[k][1])
+                         for k in set(previous_positions.keys()).difference(set(current_positions))]
+
+    yield ["Datum", datetime.strftime(outgoing.inventory.date, "%d.%m.%Y")]
+    yield ["Beschreibung", datetime.strftime(outgoing.inventory.date, "Getränkeabrechnung %B")]
+    yield []
+    yield ["Account", "Wert (Positiv = belastend)", "Notizen"]
 
-    def get_user_sum(outgoing_invoice):
-        values = OutgoingInvoiceProductUserPosition.objects \
-            .filter(productinvoice__invoice=outgoing_invoice).values_list("user__pk", "user__username") \
-            .annotate(total=Sum(F("count") * F("productinvoice__price_each"))).order_by("user__username")
-        return dict(((x, (y, z)) for x, y, z in values))
+    sum = 0
+    for name, amount in updated_positions + removed_positions:
+        yield [name, amount / 100.0]
+        sum -= amount
+    yield ["Getränke.Erträge", sum / 100.0]
 
-    def get_diff_positions():
-        current_positions = get_user_sum(outgoing)
 
-        if outgoing.correction_of is not None and difference:
-            previous_positions = get_user_sum(outgoing.correction_of)
-        else:
-            previous_positions = {}
+def _invoices_with_corrected(invoices, difference):
+    invoices = list(invoices)
+    if difference:
+        return invoices + [invoice.correction_of for invoice in invoices if invoice.correction_of_id is not None]
+    return invoices
 
-        updated_positions = [((current_positions[k][0], current_positions[k][1] - previous_positions[k][1])
-                              if k in previous_positions else current_positions[k])
-                             for k in current_positions]
-        removed_positions = [(previous_positions[k][0], -previous_positions[k][1])
-                             for k in set(previous_positions.keys()).difference(set(current_positions))]
 
-        return updated_positions + removed_positions
+def outgoing_to_csv(outgoing, f, difference=False):
+    user_sums = get_user_sums(_invoices_with_corrected([outgoing], difference))
+    csv.writer(f).writerows(outgoing_csv_rows(outgoing, user_sums, difference))
 
-    positions = get_diff_positions()
 
-    writer = csv.writer(f)
-    writer.writerow(["Datum", datetime.strftime(outgoing.inventory.date, "%d.%m.%Y")])
-    writer.writerow(["Beschreibung", datetime.strftime(outgoing.inventory.date, "Getränkeabrechnung %B")])
-    writer.writerow([])
-    writer.writerow(["Account", "Wert (Positiv = belastend)", "Notizen"])
+class _Echo(object):
+    # file-like object handing written csv lines back to the caller
 
-    sum = 0
-    for name, amount in positions:
-        writer.writerow([name, amount / 100.0])
-        sum -= amount
-    writer.writerow(["Getränke.Erträge", sum / 100.0])
-    print(outgoing.inventory.date, sum / 100.)
+    def write(self, value):
+        return value
+
+
+def stream_csv(invoices, difference=False):
+    """
+    Concatenated csv of the invoices, separated by an empty line.
+
+    :param invoices: invoices with inventory (and correction_of if difference) selected
+    :return: generator of csv lines
+    """
+    invoices = list(invoices)
+    user_sums = get_user_sums(_invoices_with_corrected(invoices, difference))
+    writer = csv.writer(_Echo())
+    for i, invoice in enumerate(invoices):
+        if i > 0:
+            yield writer.writerow([])
+        for row in outgoing_csv_rows(invoice, user_sums, difference):
+            yield writer.writerow(row)
 
 
 import sys
@@ -383,7 +549,12 @@ for idx, value in enumerate(sys.argv):
         break
 
 if is_runserver_command:
-    recalculate_thread = RecalculateThread()
-    recalculate_thread.daemon = True
-    recalculate_thread.start()
+    try:
+        recalculate_thread = RecalculateThread()
+    except ListenerRunning as e:
+        # the running worker (or another development server) recalculates the changes of this one too
+        print("Recalculation Thread not started: %s" % e)
+    else:
+        recalculate_thread.daemon = True
+        recalculate_thread.start()
 
@@ -0,0 +1,216 @@
+"""
+Latency and query statistics of views and recalculations.
+
+Statistics are kept in memory per process and shown on the stats page, which therefore only shows the share of the
+web server process that answered it. Recalculations run in the separate recalculation worker, they never show up
+there. Every measurement is also logged as a json line (with the process id) to the "main.instrumentation" logger,
+the logs of all processes together hold the complete statistics.
+"""
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.db import connection
+
+from tallybill.tally_settings import STATS_SLOWEST_QUERIES
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency histogram buckets in milliseconds, the last bucket is unbounded
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class QueryCounter(object):
+    """
+    Execute wrapper counting the queries of a connection, the time spent in them and the slowest ones.
+    """
+
+    def __init__(self, slowest=STATS_SLOWEST_QUERIES):
+        self.count = 0
+        self.seconds = 0.
+        # heap of (seconds, sql)
+        self.slowest = []
+        self._keep = slowest
+
+    def __call__(self, execute, sql, params, many, context):
+        begin = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.monotonic() - begin
+            self.count += 1
+            self.seconds += seconds
+            if len(self.slowest) < self._keep:
+                heapq.heappush(self.slowest, (seconds, sql))
+            elif self._keep and seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, sql))
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.
+        self.max_ms = 0.
+
+    def add(self, ms):
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p):
+        """
+        :return: upper bound of the bucket containing the p-th percentile, max for the unbounded bucket
+        """
+        rank = p / 100. * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    @property
+    def mean_ms(self):
+        return self.total_ms / self.count if self.count else 0.
+
+
+class Entry(object):
+    """
+    Statistics of one view or period.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.latency = Histogram()
+        self.queries = 0
+        self.query_ms = 0.
+        self.errors = 0
+
+    def add(self, seconds, counter, error):
+        self.latency.add(seconds * 1000)
+        self.queries += counter.count
+        self.query_ms += counter.seconds * 1000
+        self.errors += error
+
+    @property
+    def p50(self):
+        return self.latency.percentile(50)
+
+    @property
+    def p95(self):
+        return self.latency.percentile(95)
+
+    @property
+    def mean_queries(self):
+        return self.queries / float(self.latency.count) if self.latency.count else 0.
+
+    @property
+    def mean_query_ms(self):
+        return self.query_ms / self.latency.count if self.latency.count else 0.
+
+
+class Stats(object):
+    """
+    Statistics of all views ("view") and recalculated periods ("recalculation") of this process only.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._entries = {}
+            # heap of (seconds, sql, entry name)
+            self._slowest = []
+            self.since = time.time()
+
+    def record(self, kind, name, seconds, counter, error=False):
+        with self._lock:
+            key = (kind, name)
+            if key not in self._entries:
+                self._entries[key] = Entry(name)
+            self._entries[key].add(seconds, counter, error)
+            for query_seconds, sql in counter.slowest:
+                if len(self._slowest) < STATS_SLOWEST_QUERIES:
+                    heapq.heappush(self._slowest, (query_seconds, sql, name))
+                elif query_seconds > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, (query_seconds, sql, name))
+        logger.info(json.dumps({"pid": os.getpid(), "kind": kind, "name": name, "ms": round(seconds * 1000, 3),
+                                "queries": counter.count, "query_ms": round(counter.seconds * 1000, 3),
+                                "error": error}))
+
+    def entries(self, kind):
+        """
+        :return: entries of a kind, slowest mean latency first
+        """
+        with self._lock:
+            entries = [entry for (entry_kind, _), entry in self._entries.items() if entry_kind == kind]
+        return sorted(entries, key=lambda entry: -entry.latency.mean_ms)
+
+    def slowest_queries(self):
+        """
+        :return: list of (milliseconds, sql, view or period) of the slowest queries, slowest first
+        """
+        with self._lock:
+            return [(seconds * 1000, sql, name) for seconds, sql, name in sorted(self._slowest, reverse=True)]
+
+
+stats = Stats()
+
+
+@contextmanager
+def instrument(kind, name):
+    """
+    Record the wall time and queries of the enclosed block.
+    """
+    counter = QueryCounter()
+    begin = time.monotonic()
+    error = True
+    try:
+        with connection.execute_wrapper(counter):
+            yield counter
+        error = False
+    finally:
+        stats.record(kind, name, time.monotonic() - begin, counter, error)
+
+
+class InstrumentationMiddleware(object):
+    """
+    Records latency and queries of every view, including the streaming of the response.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        begin = time.monotonic()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        if response.streaming:
+            response.streaming_content = self._streamed(response.streaming_content, request, response, counter,
+                                                        begin)
+        else:
+            self._record(request, response, counter, begin)
+        return response
+
+    def _streamed(self, content, request, response, counter, begin):
+        with connection.execute_wrapper(counter):
+            for chunk in content:
+                yield chunk
+        self._record(request, response, counter, begin)
+
+    @staticmethod
+    def _record(request, response, counter, begin):
+        match = request.resolver_match
+        name = match.func.__name__ if match is not None else "unresolved"
+        stats.record("view", name, time.monotonic() - begin, counter, response.status_code >= 500)
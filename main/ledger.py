@@ -0,0 +1,337 @@
+from collections import namedtuple
+
+import numpy
+
+from main.models import Consumption, ConsumptionRollup, CumulativeOrder, ProductInventory
+from tallybill.tally_settings import PROFIT_FACTOR, PROFIT_FIXED_CENTS
+
+
+# result of billing a single product in a period
+ProductPosition = namedtuple("ProductPosition", ["product_id", "loss", "price_each", "total", "profit",
+                                                 "user_counts"])
+
+
+def _columns(rows, width):
+    # transpose a list of value tuples into `width` lists
+    rows = list(rows)
+    if not rows:
+        return tuple([] for _ in range(width))
+    return tuple(list(column) for column in zip(*rows))
+
+
+def _ordinals(dates):
+    return numpy.array([d.toordinal() for d in dates], dtype=numpy.int64)
+
+
+class IdIndex(object):
+    """
+    Dense mapping of model ids to array offsets, e.g. to the columns of a table.
+
+    Offsets follow the order of the ids passed in.
+    """
+
+    def __init__(self, ids):
+        self.ids = numpy.array(list(ids), dtype=numpy.int64)
+        self._offsets = numpy.full(self.ids.max() + 1 if len(self.ids) else 0, -1, dtype=numpy.intp)
+        self._offsets[self.ids] = numpy.arange(len(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id_):
+        return self.offset(id_) >= 0
+
+    def offset(self, id_):
+        # offset of a single id, -1 if it is unknown
+        return int(self._offsets[id_]) if 0 <= id_ < len(self._offsets) else -1
+
+    def offsets(self, ids):
+        # offsets of a whole column of ids, -1 for unknown ids
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        result = numpy.full(ids.shape, -1, dtype=numpy.intp)
+        known = (ids >= 0) & (ids < len(self._offsets))
+        result[known] = self._offsets[ids[known]]
+        return result
+
+
+class OrderColumns(object):
+    """
+    CumulativeOrder rows as arrays, converted once to build the ledgers of many periods.
+    """
+
+    def __init__(self, rows):
+        """
+        :param rows: (product id, date, count, cents, each cents) of CumulativeOrder sorted by (product id, pk)
+        """
+        product_ids, dates, cumulative_counts, cumulative_cents, prices = _columns(rows, 5)
+        self.product_ids = numpy.array(product_ids, dtype=numpy.int64)
+        self.dates = _ordinals(dates)
+        self.cumulative_counts = numpy.array(cumulative_counts, dtype=numpy.int64)
+        self.cumulative_cents = numpy.array(cumulative_cents, dtype=numpy.int64)
+        self.prices = numpy.array(prices, dtype=numpy.int64)
+
+
+def date_buckets(dates, bucket_dates):
+    """
+    Row of a table with one row per date in bucket_dates (ascending) for each of the dates.
+
+    Every date falls into the first bucket on or after it, -1 for dates after the last one.
+    """
+    bucket_dates = _ordinals(bucket_dates)
+    rows = numpy.searchsorted(bucket_dates, _ordinals(dates), side="left")
+    return numpy.where(rows < len(bucket_dates), rows, -1)
+
+
+def fill_table(shape, rows, columns, values):
+    # sum values into a table, entries with a row or column of -1 are dropped
+    table = numpy.zeros(shape, dtype=int)
+    rows, columns = numpy.asarray(rows, dtype=numpy.intp), numpy.asarray(columns, dtype=numpy.intp)
+    known = (rows >= 0) & (columns >= 0)
+    numpy.add.at(table, (rows[known], columns[known]), numpy.asarray(values, dtype=int)[known])
+    return table
+
+
+# rows sorted by (product offset, date) have ascending keys product offset * _DAYS + date ordinal
+_DAYS = 10 ** 7
+
+
+def _last_until(products, dates, n, date_ordinal):
+    # index of the last row until (and including) the date for each of n products, -1 if there is none
+    keys = products.astype(numpy.int64) * _DAYS + dates
+    idx = numpy.searchsorted(keys, numpy.arange(n, dtype=numpy.int64) * _DAYS + date_ordinal, side="right") - 1
+    found = idx >= 0
+    found[found] = products[idx[found]] == numpy.flatnonzero(found)
+    return numpy.where(found, idx, -1)
+
+
+def _take(values, idx):
+    # values[idx], 0 where idx is -1
+    if len(values) == 0:
+        return numpy.zeros(len(idx), dtype=numpy.int64)
+    return numpy.where(idx >= 0, values[idx], 0)
+
+
+def real_consumption(previous_counts, orders, counts):
+    # total consumption according to inventories and orders, including loss
+    return previous_counts + orders - counts
+
+
+def real_consumption_table(counts, orders):
+    """
+    Real consumption of every period given the inventory counts and the orders of the periods.
+
+    Tables have one row per inventory (ascending by date) and one column per product,
+    there is no stock before the first inventory.
+    """
+    previous_counts = numpy.zeros_like(counts)
+    previous_counts[1:] = counts[:-1]
+    return real_consumption(previous_counts, orders, counts)
+
+
+def fifo_cost(cumulative_counts, cumulative_cents, prices, positions):
+    """
+    Cost of the first `positions` items of a sequence of orders consumed first in, first out.
+
+    cumulative_counts/cumulative_cents are the running totals of the ordered quantities and their costs,
+    positions must not exceed the last cumulative count.
+    """
+    positions = numpy.asarray(positions, dtype=numpy.int64)
+    if len(cumulative_counts) == 0:
+        return numpy.zeros(positions.shape, dtype=numpy.int64)
+    idx = numpy.minimum(numpy.searchsorted(cumulative_counts, positions, side="left"), len(cumulative_counts) - 1)
+    # everything of order idx that is not consumed yet is subtracted from its running total
+    return cumulative_cents[idx] - (cumulative_counts[idx] - positions) * prices[idx]
+
+
+class PeriodLedger(object):
+    """
+    All numbers needed to bill a period, loaded with a constant number of queries.
+
+    Every array is indexed by the position of the product in `product_ids`.
+    """
+
+    def __init__(self, product_ids, counted, previous_counts, counts, orders_before, orders_in_period,
+                 order_products, order_dates, cumulative_counts, cumulative_cents, order_prices,
+                 consumption_products, consumption_users, consumption_counts):
+        self.product_ids = product_ids
+        # whether the product was counted in one of the inventories (only those are billed)
+        self.counted = counted
+        self.previous_counts = previous_counts
+        self.counts = counts
+        # orders until the beginning of the period / during the period
+        self.orders_before = orders_before
+        self.orders_in_period = orders_in_period
+        # all orders of all products sorted by (product, date) with running totals per product,
+        # used for FIFO pricing
+        self.order_products = order_products
+        self.order_dates = order_dates
+        self.cumulative_counts = cumulative_counts
+        self.cumulative_cents = cumulative_cents
+        self.order_prices = order_prices
+        # listed consumptions of the period summed per (product, user), sorted by (product, user)
+        self.consumption_products = consumption_products
+        self.consumption_users = consumption_users
+        self.consumption_counts = consumption_counts
+
+    @classmethod
+    def load(cls, inventory, previous_inventory=None, product_ids=None):
+        """
+        :param inventory: inventory closing the period, may be unsaved (e.g. an inventory being entered)
+        :param previous_inventory: inventory preceding inventory, None if it is the first period
+        :param product_ids: products to load, defaults to all products counted in one of the inventories
+        """
+        inventory_ids = [i.pk for i in (inventory, previous_inventory) if i is not None and i.pk is not None]
+        product_inventories = ProductInventory.objects.filter(inventory_id__in=inventory_ids)
+        inventory_rows = list(product_inventories.values_list("inventory_id", "product_id", "count"))
+        if product_ids is None:
+            product_filter = product_inventories.values("product_id")
+        else:
+            product_filter = list(product_ids)
+
+        order_rows = list(CumulativeOrder.objects.filter(product_id__in=product_filter).order_by("product_id", "pk")
+                          .values_list("product_id", "date", "count", "cents", "each_cents"))
+        if inventory.pk is not None:
+            consumption_rows = list(
+                ConsumptionRollup.objects.filter(inventory_id=inventory.pk, product_id__in=product_filter)
+                .order_by("product_id", "user_id").values_list("product_id", "user_id", "count"))
+        else:
+            # there are no rollup rows of an unsaved inventory's period, its bounds are given explicitly
+            period = (None, previous_inventory.date if previous_inventory is not None else None, inventory.date)
+            consumption_rows = sorted((row.product_id, row.user_id, row.count) for row in ConsumptionRollup._aggregate(
+                period, Consumption.objects.filter(product_id__in=product_filter)))
+        return cls.from_rows(inventory, previous_inventory, product_ids, inventory_rows, order_rows, consumption_rows)
+
+    @classmethod
+    def from_rows(cls, inventory, previous_inventory, product_ids, inventory_rows, order_rows, consumption_rows):
+        """
+        Build the ledger from rows already loaded from the database, rows of other products are ignored.
+
+        :param inventory_rows: (inventory id, product id, count) counted in the inventories
+        :param order_rows: (product id, date, count, cents, each cents) of CumulativeOrder sorted by (product id, pk),
+            or OrderColumns of them
+        :param consumption_rows: (product id, user id, count) of ConsumptionRollup of the period sorted by
+            (product id, user id)
+        """
+        if product_ids is None:
+            product_ids = set(p for _, p, _ in inventory_rows)
+        products = IdIndex(sorted(set(product_ids)))
+        n = len(products)
+
+        inventory_of_row, product_of_row, count_of_row = (numpy.array(c, dtype=numpy.int64)
+                                                          for c in _columns(inventory_rows, 3))
+        row_products = products.offsets(product_of_row)
+        known = row_products >= 0
+        current = known & (inventory_of_row == (inventory.pk or 0))
+        previous = known & ~current
+        counted = numpy.zeros(n, dtype=bool)
+        counted[row_products[known]] = True
+        previous_counts = numpy.zeros(n, dtype=numpy.int64)
+        counts = numpy.zeros(n, dtype=numpy.int64)
+        numpy.add.at(counts, row_products[current], count_of_row[current])
+        numpy.add.at(previous_counts, row_products[previous], count_of_row[previous])
+
+        date_from = previous_inventory.date if previous_inventory is not None else None
+        date_until = inventory.date
+
+        orders = order_rows if isinstance(order_rows, OrderColumns) else OrderColumns(order_rows)
+        order_products = products.offsets(orders.product_ids)
+        known = order_products >= 0
+        order_products = order_products[known]
+        order_dates = orders.dates[known]
+        cumulative_counts = orders.cumulative_counts[known]
+        cumulative_cents = orders.cumulative_cents[known]
+        order_prices = orders.prices[known]
+
+        # the running totals at the boundaries of the period are found by binary search
+        orders_until = _take(cumulative_counts, _last_until(order_products, order_dates, n, date_until.toordinal()))
+        orders_before = numpy.zeros(n, dtype=numpy.int64)
+        if date_from is not None:
+            orders_before = _take(cumulative_counts,
+                                  _last_until(order_products, order_dates, n, date_from.toordinal()))
+        orders_in_period = orders_until - orders_before
+
+        consumption_product_ids, consumption_users, consumption_counts = _columns(consumption_rows, 3)
+        consumption_products = products.offsets(consumption_product_ids)
+        known = consumption_products >= 0
+
+        return cls(products.ids, counted, previous_counts, counts, orders_before, orders_in_period,
+                   order_products, order_dates, cumulative_counts, cumulative_cents, order_prices,
+                   consumption_products[known],
+                   numpy.array(consumption_users, dtype=numpy.int64)[known],
+                   numpy.array(consumption_counts, dtype=numpy.int64)[known])
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def real_consumption(self):
+        return real_consumption(self.previous_counts, self.orders_in_period, self.counts)
+
+    def expected_counts(self):
+        # inventory counts expected if there was no loss
+        return self.previous_counts + self.orders_in_period - self.listed_consumption()
+
+    def listed_consumption(self):
+        listed = numpy.zeros(len(self), dtype=numpy.int64)
+        numpy.add.at(listed, self.consumption_products, self.consumption_counts)
+        return listed
+
+    def loss_factor(self):
+        # factor to compensate loss
+        real = self.real_consumption()
+        listed = self.listed_consumption()
+        factor = numpy.divide(real, listed, out=numpy.ones(len(self)), where=listed != 0)
+        # loss cannot be compensated, since (apparently) nobody consumed nothing
+        # (even though real_consumption may indicate consumptions)
+        factor[(listed == 0) & (real != 0)] = numpy.inf
+        return factor
+
+    def loss(self):
+        factor = self.loss_factor()
+        # negative real consumptions: loss not really interpretable
+        return numpy.where(factor > 0, -(1. - factor) * 100., -numpy.inf)
+
+    def avg_price_for_consumed(self):
+        # avg price of products that where consumed, assuming products are sold first in, first out
+        n = len(self)
+        # chain the running totals of all products into a single ascending sequence
+        last = _last_until(self.order_products, self.order_dates, n, _DAYS - 1)
+        totals = _take(self.cumulative_counts, last)
+        first = numpy.concatenate(([0], numpy.cumsum(totals)[:-1])).astype(numpy.int64)
+        first_cents = numpy.concatenate(([0], numpy.cumsum(_take(self.cumulative_cents, last))[:-1]))
+        cumulative_counts = self.cumulative_counts + first[self.order_products]
+        cumulative_cents = self.cumulative_cents + first_cents[self.order_products].astype(numpy.int64)
+
+        consumed_before = self.orders_before - self.previous_counts
+        skip = numpy.clip(consumed_before, 0, totals)
+        until = numpy.minimum(skip + numpy.maximum(self.real_consumption(), 0), totals)
+
+        cost = (fifo_cost(cumulative_counts, cumulative_cents, self.order_prices, first + until) -
+                fifo_cost(cumulative_counts, cumulative_cents, self.order_prices, first + skip))
+        quantity = until - skip
+        return numpy.divide(cost, quantity, out=numpy.zeros(n), where=quantity != 0)
+
+    def positions(self):
+        """
+        Bill every counted product of the period.
+
+        :return: list of ProductPosition
+        """
+        loss_factor = numpy.maximum(1., self.loss_factor())
+        compensable = numpy.isfinite(loss_factor)
+        loss_factor = numpy.where(compensable, loss_factor, 0.)
+        avg_price = self.avg_price_for_consumed()
+        each_cents = numpy.where(compensable, avg_price * loss_factor * PROFIT_FACTOR + PROFIT_FIXED_CENTS, 0)
+        each_cents = each_cents.astype(numpy.int64)
+        each_no_profit = (avg_price * loss_factor).astype(numpy.int64)
+
+        product_totals = self.listed_consumption()
+        totals = product_totals * each_cents
+        profits = totals - product_totals * each_no_profit
+        loss = self.loss()
+
+        bounds = numpy.searchsorted(self.consumption_products, numpy.arange(len(self) + 1))
+        return [ProductPosition(int(self.product_ids[i]), float(loss[i]), int(each_cents[i]),
+                                int(totals[i]), int(profits[i]),
+                                list(zip(self.consumption_users[bounds[i]:bounds[i + 1]].tolist(),
+                                         self.consumption_counts[bounds[i]:bounds[i + 1]].tolist())))
+                for i in numpy.flatnonzero(self.counted)]
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# -*- coding: <utf-8> -*-
+import json
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from main.benchmark import LedgerGenerator, run_benchmark
+from main.sqlite import switched_database
+
+
+class Command(BaseCommand):
+    """
+    generates a synthetic ledger in a new database and times the key operations on it.
+    the report (wall time and queries per operation, construction time per model instance) is written as json, to
+    compare commits.
+    """
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=30)
+        parser.add_argument("--products", type=int, default=20)
+        parser.add_argument("--years", type=int, default=3)
+        parser.add_argument("--consumptions", type=int, default=100000)
+        parser.add_argument("--seed", type=int, default=0)
+        # read only operations are repeated, the fastest run is reported
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--output", default="benchmark.json")
+        # keep the generated database at this path instead of a temporary file, the path must not exist
+        parser.add_argument("--database")
+
+    def handle(self, *args, **options):
+        if options["database"]:
+            path = options["database"]
+            if os.path.exists(path):
+                # never overwrite a database, it may be the one in use
+                raise CommandError("%s exists, choose a new path for the benchmark database" % path)
+        else:
+            fd, path = tempfile.mkstemp(suffix=".sqlite3")
+            os.close(fd)
+
+        generator = LedgerGenerator(options["users"], options["products"], options["years"],
+                                    options["consumptions"], options["seed"])
+        with switched_database(path, delete=not options["database"]):
+            call_command("migrate", verbosity=0)
+            report = run_benchmark(generator, options["repeat"])
+
+        with open(options["output"], "w") as f:
+            json.dump(report, f, indent=2)
+        for name, result in report["operations"].items():
+            print("%-40s %9.3f s %7d queries" % (name, result["seconds"], result["queries"]))
+        for name, result in report["construction"].items():
+            print("%-40s %9.2f us %7d queries" % ("construct %s" % name, result["microseconds"], result["queries"]))
+        print("Report written to %s" % options["output"])
@@ -4,7 +4,7 @@ from datetime import date, datetime
 from django.core.management.base import BaseCommand
 from django.db import transaction
 
-from main.billing import BillingPeriod
+from main.billing import BillingPeriod, recalculate_all
 from main.models import Inventory
 
 
@@ -15,8 +15,9 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         # declare file to import from
         parser.add_argument("--all", action="store_true")
+        # compute the periods in parallel worker processes
+        parser.add_argument("--jobs", type=int, default=1)
 
-    @transaction.atomic
     def handle(self, *args, **options):
         print(options["all"])
         if options["all"]:
@@ -28,8 +29,12 @@ class Command(BaseCommand):
 
         begin = datetime.now()
 
-        for inventory in inventories:
-            BillingPeriod(inventory).recalculate_temporary_invoices()
+        if options["jobs"] > 1:
+            recalculate_all(list(inventories), options["jobs"])
+        else:
+            with transaction.atomic():
+                for inventory in inventories:
+                    BillingPeriod(inventory).recalculate_temporary_invoices(full=options["all"])
 
         diff = datetime.now() - begin
         print(diff)
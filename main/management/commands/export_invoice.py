@@ -2,47 +2,37 @@
 # -*- coding: <utf-8> -*-
 import csv
 import os
-from datetime import date, datetime
+from datetime import datetime
 from django.core.management.base import BaseCommand
 from django.db import transaction
-from django.db.models import F
-from django.db.models.aggregates import Sum
-from django.db.models.functions import Cast
-from django.forms import FloatField
 from os import makedirs
 
-from main.billing import BillingPeriod, outgoing_to_csv
-from main.models import Inventory, OutgoingInvoice, OutgoingInvoiceProductUserPosition
+from main.billing import get_user_sums, outgoing_csv_rows
+from main.models import OutgoingInvoice
 
 
 class Command(BaseCommand):
     """
-    imports Getraenke.xlsx into database. clean database required.
+    exports the latest approved invoices as csv, one file per invoice.
     """
     def add_arguments(self, parser):
-        # declare file to import from
         parser.add_argument("-output_dir", default="output")
         parser.add_argument("-invoice")
 
-    def export(self, outgoing, options):
-
-        positions = OutgoingInvoiceProductUserPosition.objects \
-            .filter(productinvoice__invoice=outgoing).values_list("user__username") \
-            .annotate(total=Sum(F("count") * F("productinvoice__price_each"))).order_by("user__username")
-
-        with open(os.path.join(options["output_dir"],
-                               datetime.strftime(outgoing.inventory.date, "%Y-%m-%d.csv")),
-                  "w", encoding="utf-8", newline="\n") as f:
-            outgoing_to_csv(outgoing, f)
-
     @transaction.atomic
     def handle(self, *args, **options):
         if not os.path.exists(options["output_dir"]):
             makedirs(options["output_dir"])
 
+        invoices = OutgoingInvoice.objects.select_related("inventory").order_by("inventory__date")
         if "invoice" in options and options["invoice"]:
-            invoices = [OutgoingInvoice.objects.get(inventory__date=datetime.strptime(options["invoice"], "%Y-%m-%d"))]
-        else:
-            invoices = OutgoingInvoice.objects.all()
+            invoices = [invoices.get(inventory__date=datetime.strptime(options["invoice"], "%Y-%m-%d"))]
+        invoices = list(invoices)
+        # user sums of all invoices in a single query
+        user_sums = get_user_sums(invoices)
         for outgoing in invoices:
-            self.export(outgoing, options )
\ No newline at end of file
+            with open(os.path.join(options["output_dir"],
+                                   datetime.strftime(outgoing.inventory.date, "%Y-%m-%d.csv")),
+                      "w", encoding="utf-8", newline="\n") as f:
+                csv.writer(f).writerows(outgoing_csv_rows(outgoing, user_sums))
+        print("Exported %d invoices to %s" % (len(invoices), options["output_dir"]))
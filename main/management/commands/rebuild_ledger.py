@@ -0,0 +1,21 @@
+#!/usr/bin/python
+# -*- coding: <utf-8> -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.models import ChartSeries, CumulativeOrder, ConsumptionRollup
+
+
+class Command(BaseCommand):
+    """
+    rebuilds all tables derived from the ledger.
+    """
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        print("Rebuilding cumulative orders...")
+        CumulativeOrder.rebuild()
+        print("Rebuilding consumption rollup...")
+        ConsumptionRollup.rebuild()
+        print("Rebuilding chart series...")
+        ChartSeries.rebuild()
@@ -2,18 +2,22 @@
 # -*- coding: <utf-8> -*-
 
 from django.contrib.auth.models import User
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 
 from main.billing import RecalculateThread
 from main.models import ProductType
+from main.notify import ListenerRunning
 
 
 class Command(BaseCommand):
 
     @transaction.atomic
     def handle(self, *args, **options):
-        r_thread = RecalculateThread()
+        try:
+            r_thread = RecalculateThread()
+        except ListenerRunning as e:
+            raise CommandError(str(e))
         r_thread.start()
         try:
             r_thread.join()
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: <utf-8> -*-
+import random
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, OperationalError
+from django.test.utils import override_settings
+
+from main.billing import BillingPeriod, get_user_sums
+from main.models import Consumption, Inventory, OutgoingInvoice, Product
+from main.sqlite import copy_database, effective_pragmas, switched_database
+
+# sqlite's defaults, journal_mode has to be given as it is stored in the database file
+DEFAULT_PRAGMAS = {"journal_mode": "delete", "synchronous": "full", "cache_size": -2000, "mmap_size": 0,
+                   "temp_store": "default"}
+
+
+class _Load(object):
+    """
+    Tallies, invoice reads and recalculations running concurrently against the default database.
+    """
+
+    def __init__(self, seconds, writers, readers):
+        self._seconds = seconds
+        self._writers = writers
+        self._readers = readers
+        self._lock = threading.Lock()
+        self.counts = {"tallies": 0, "reads": 0, "recalculations": 0, "locked": 0}
+        self.tally_seconds = []
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counts[key] += n
+
+    def _loop(self, work):
+        deadline = time.monotonic() + self._seconds
+        try:
+            while time.monotonic() < deadline:
+                try:
+                    work()
+                except OperationalError:
+                    self._count("locked")
+        finally:
+            connection.close()
+
+    def run(self):
+        inventory = Inventory.objects.order_by("-date").first()
+        if inventory is None:
+            raise CommandError("benchmark needs at least one inventory")
+        previous = Inventory.get_prev_inventory_by_date(inventory.date)
+        date = inventory.date - timedelta(days=1)
+        if previous is not None and date <= previous.date:
+            date = inventory.date
+        users = list(User.objects.all())
+        products = list(Product.objects.all())
+        if not users or not products:
+            raise CommandError("benchmark needs users and products")
+
+        def tally():
+            begin = time.monotonic()
+            Consumption(date=date, user=random.choice(users), product=random.choice(products), count=1,
+                        issued_by=users[0]).save()
+            with self._lock:
+                self.tally_seconds.append(time.monotonic() - begin)
+            self._count("tallies")
+
+        def read():
+            get_user_sums(list(OutgoingInvoice.objects_all.filter(inventory=inventory)))
+            self._count("reads")
+
+        def recalculate():
+            changed = list(Inventory.objects.filter(may_have_changed=True))
+            for changed_inventory in changed:
+                if BillingPeriod(changed_inventory).recalculate_temporary_invoices():
+                    self._count("recalculations")
+            if not changed:
+                time.sleep(0.01)
+
+        threads = [threading.Thread(target=self._loop, args=(work, )) for work in
+                   [tally] * self._writers + [read] * self._readers + [recalculate]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+class Command(BaseCommand):
+    """
+    shows the effective sqlite settings. with --benchmark compares the throughput of concurrent tallies,
+    invoice reads and recalculations on a copy of the database with sqlite's defaults and the configured pragmas.
+    """
+    def add_arguments(self, parser):
+        parser.add_argument("--benchmark", action="store_true")
+        # duration of each benchmark run
+        parser.add_argument("--seconds", type=float, default=10)
+        parser.add_argument("--writers", type=int, default=2)
+        parser.add_argument("--readers", type=int, default=2)
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("database is not sqlite")
+        self._print_pragmas(effective_pragmas(connection))
+        if not options["benchmark"]:
+            return
+        for name, pragmas in [("sqlite defaults", DEFAULT_PRAGMAS), ("SQLITE_PRAGMAS", settings.SQLITE_PRAGMAS)]:
+            print()
+            print("Benchmark with %s:" % name)
+            self._benchmark(pragmas, options["seconds"], options["writers"], options["readers"])
+
+    @staticmethod
+    def _print_pragmas(pragmas):
+        for name, value in pragmas.items():
+            print("%-14s %s" % (name, value))
+
+    def _benchmark(self, pragmas, seconds, writers, readers):
+        with switched_database(copy_database(connection.settings_dict["NAME"])):
+            with override_settings(SQLITE_PRAGMAS=pragmas):
+                self._print_pragmas(effective_pragmas(connection))
+                load = _Load(seconds, writers, readers)
+                begin = time.monotonic()
+                load.run()
+                elapsed = time.monotonic() - begin
+
+        for key, count in sorted(load.counts.items()):
+            print("%-14s %6d  %8.1f/s" % (key, count, count / elapsed))
+        if load.tally_seconds:
+            tally_seconds = sorted(load.tally_seconds)
+            print("tally latency  median %.1f ms, max %.1f ms" % (
+                tally_seconds[len(tally_seconds) // 2] * 1000, tally_seconds[-1] * 1000))
@@ -0,0 +1,46 @@
+# Generated by Django 2.2.24 on 2026-10-18 11:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+import main.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_remove_outgoinginvoice_date_new'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='consumption',
+            name='date',
+            field=models.DateField(default=main.models.date_now),
+        ),
+        migrations.AlterField(
+            model_name='incominginvoice',
+            name='date',
+            field=models.DateField(default=main.models.date_now),
+        ),
+        migrations.AlterField(
+            model_name='inventory',
+            name='date',
+            field=models.DateField(default=main.models.date_now, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='outgoinginvoice',
+            name='date',
+            field=models.DateTimeField(default=main.models.datetime_now_tz),
+        ),
+        migrations.CreateModel(
+            name='DirtyProduct',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('inventory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.Inventory')),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='main.Product')),
+            ],
+            options={
+                'unique_together': {('inventory', 'product')},
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.24 on 2026-10-18 11:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_cumulative_orders(apps, schema_editor):
+    Order = apps.get_model('main', 'Order')
+    CumulativeOrder = apps.get_model('main', 'CumulativeOrder')
+    rows = []
+    last_product, count, cents = None, 0, 0
+    for product_id, date, order_count, each_cents in (Order.objects.order_by("product_id", "incoming_invoice__date", "pk")
+            .values_list("product_id", "incoming_invoice__date", "count", "each_cents")):
+        if product_id != last_product:
+            last_product, count, cents = product_id, 0, 0
+        count += order_count
+        cents += order_count * each_cents
+        rows.append(CumulativeOrder(product_id=product_id, date=date, each_cents=each_cents, count=count, cents=cents))
+    CumulativeOrder.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_dirtyproduct'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CumulativeOrder',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('each_cents', models.IntegerField()),
+                ('count', models.BigIntegerField()),
+                ('cents', models.BigIntegerField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.Product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='cumulativeorder',
+            index=models.Index(fields=['product', 'date'], name='main_cumula_product_ef3acb_idx'),
+        ),
+        migrations.RunPython(build_cumulative_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.24 on 2026-10-18 11:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_cumulativeorder'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='consumption',
+            index=models.Index(fields=['product', 'date'], name='main_consum_product_9d430b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='consumption',
+            index=models.Index(fields=['user', 'date'], name='main_consum_user_id_d5d6df_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='incominginvoice',
+            index=models.Index(fields=['date'], name='main_incomi_date_e57ba5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['product', 'incoming_invoice'], name='main_order_product_68d85e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outgoinginvoice',
+            index=models.Index(fields=['inventory', 'is_frozen'], name='main_outgoi_invento_3b8184_idx'),
+        ),
+    ]
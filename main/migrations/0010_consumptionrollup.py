@@ -0,0 +1,57 @@
+# Generated by Django 2.2.24 on 2026-10-18 11:23
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Max, Sum
+
+
+def build_consumption_rollup(apps, schema_editor):
+    Consumption = apps.get_model('main', 'Consumption')
+    ConsumptionRollup = apps.get_model('main', 'ConsumptionRollup')
+    Inventory = apps.get_model('main', 'Inventory')
+    periods = []
+    date_from = None
+    for inventory_id, date in Inventory.objects.order_by("date").values_list("pk", "date"):
+        periods.append((inventory_id, date_from, date))
+        date_from = date
+    periods.append((None, date_from, None))
+    rows = []
+    for inventory_id, date_from, date_until in periods:
+        consumptions = Consumption.objects.all()
+        if date_from is not None:
+            consumptions = consumptions.filter(date__gt=date_from)
+        if date_until is not None:
+            consumptions = consumptions.filter(date__lte=date_until)
+        for product_id, user_id, count, last_date in (consumptions.values("product_id", "user_id")
+                .annotate(count=Sum("count"), last_date=Max("date")).order_by()
+                .values_list("product_id", "user_id", "count", "last_date")):
+            rows.append(ConsumptionRollup(inventory_id=inventory_id, product_id=product_id, user_id=user_id,
+                                          count=count, last_date=last_date))
+    ConsumptionRollup.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0009_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConsumptionRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField()),
+                ('last_date', models.DateField()),
+                ('inventory', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='main.Inventory')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.Product')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('inventory', 'product', 'user')},
+            },
+        ),
+        migrations.RunPython(build_consumption_rollup, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.24 on 2026-10-18 11:34
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_consumptionrollup'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='dirtyproduct',
+            unique_together=set(),
+        ),
+    ]
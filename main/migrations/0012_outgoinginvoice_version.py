@@ -0,0 +1,18 @@
+# Generated by Django 2.2.24 on 2026-10-18 11:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_dirtyproduct_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoinginvoice',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.24 on 2026-10-18 11:46
+
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Q
+
+
+def build_chart_series(apps, schema_editor):
+    ChartSeries = apps.get_model('main', 'ChartSeries')
+    OutgoingInvoice = apps.get_model('main', 'OutgoingInvoice')
+    OutgoingInvoiceProductPosition = apps.get_model('main', 'OutgoingInvoiceProductPosition')
+    Product = apps.get_model('main', 'Product')
+    latest = Q(is_frozen=True) & (Q(corrected_by=None) | Q(corrected_by__is_frozen=False))
+    invoices = list(OutgoingInvoice.objects.filter(latest).order_by("inventory__date")
+                    .values_list("pk", "inventory__date", "profit"))
+    columns = dict((pk, column) for column, (pk, _, _) in enumerate(invoices))
+    losses = dict((product_id, [0] * len(invoices)) for product_id in Product.objects.values_list("pk", flat=True))
+    for invoice_id, product_id, loss, total in OutgoingInvoiceProductPosition.objects.filter(
+            (Q(invoice__corrected_by=None) | Q(invoice__corrected_by__is_frozen=False)) &
+            Q(invoice__is_frozen=True)).values_list("invoice_id", "product_id", "loss", "total"):
+        losses[product_id][columns[invoice_id]] = abs(loss) if abs(loss) != float("+inf") else (
+            0 if total < 100 else 100)
+    ChartSeries.objects.bulk_create(
+        [ChartSeries(series="dates", values=json.dumps([str(d) for _, d, _ in invoices])),
+         ChartSeries(series="profit", values=json.dumps([p / 100 for _, _, p in invoices]))] +
+        [ChartSeries(series="loss", product_id=product_id, values=json.dumps(losses[product_id]))
+         for product_id in sorted(losses)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_outgoinginvoice_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChartSeries',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('series', models.CharField(max_length=10)),
+                ('values', models.TextField()),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='main.Product')),
+            ],
+        ),
+        migrations.RunPython(build_chart_series, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.24 on 2026-10-18 11:48
+
+from django.db import migrations, models
+
+
+def create_ledger_version(apps, schema_editor):
+    apps.get_model('main', 'LedgerVersion').objects.create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_chartseries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_ledger_version, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 2.2.24 on 2026-10-18 11:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_invoice_chains(apps, schema_editor):
+    OutgoingInvoice = apps.get_model('main', 'OutgoingInvoice')
+    invoices = list(OutgoingInvoice.objects.values_list("pk", "correction_of_id", "is_frozen"))
+    corrected_by = dict((correction_of_id, (pk, is_frozen)) for pk, correction_of_id, is_frozen in invoices
+                        if correction_of_id is not None)
+    for root, correction_of_id, is_frozen in invoices:
+        if correction_of_id is not None:
+            continue
+        chain = [(root, is_frozen)]
+        while chain[-1][0] in corrected_by:
+            chain.append(corrected_by[chain[-1][0]])
+        frozen = [pk for pk, is_frozen in chain if is_frozen]
+        for position, (pk, _) in enumerate(chain):
+            OutgoingInvoice.objects.filter(pk=pk).update(chain_root_id=root, chain_position=position,
+                                                         is_latest_frozen=bool(frozen) and pk == frozen[-1])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_ledgerversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoinginvoice',
+            name='chain_position',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='outgoinginvoice',
+            name='chain_root',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main.OutgoingInvoice'),
+        ),
+        migrations.AddField(
+            model_name='outgoinginvoice',
+            name='is_latest_frozen',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddIndex(
+            model_name='outgoinginvoice',
+            index=models.Index(fields=['chain_root', 'chain_position'], name='main_outgoi_chain_r_01872c_idx'),
+        ),
+        migrations.RunPython(build_invoice_chains, migrations.RunPython.noop),
+    ]
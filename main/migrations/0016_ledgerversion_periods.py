@@ -0,0 +1,18 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_invoice_chain'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ledgerversion',
+            name='periods',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -1,14 +1,19 @@
+import json
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
 from datetime import datetime
 
 import pytz
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models import Transform, F
-from django.db.models.base import ModelBase
+from django.core.signals import request_started, request_finished
+from django.db import models, transaction, connections, DEFAULT_DB_ALIAS
+from django.db.models import Transform, F, Max, Sum
 from django.db.models.query_utils import Q
-from django.db.models.signals import post_save
+from django.db.models.signals import class_prepared, post_save, post_delete
 from django.dispatch import receiver
 
+from main.notify import notify_recalculation
 from tallybill import settings
 
 
@@ -20,67 +25,132 @@ def date_now():
     return datetime_now_tz().date()
 
 
-def FilteredManager(query):
+def FilteredManager(query, queryset_class=models.QuerySet):
 
-    class _FilteredManager(models.Manager):
+    class _FilteredManager(models.Manager.from_queryset(queryset_class)):
 
         def get_queryset(self):
             return super(_FilteredManager, self).get_queryset().filter(query)
     return _FilteredManager()
 
 
-class CustomMeta(ModelBase):
+class FieldTrackerMixin(object):
     """
-    def __new__(cls, name, bases, attr):
-
-        def prop_gen(field_name):
-            def prop(self):
-                return getattr(self, '%s_original' % field_name) != getattr(self, field_name)
-
-            return property(prop)
+    Remembers the values of track_fields an instance was created or loaded with.
 
-        add_attr = {}
-        if "track_fields" in attr:
-            for field in attr["track_fields"]:
-                add_attr[field + "_changed"] = prop_gen(field)
-        return super(CustomMeta, cls).__new__(cls, name, bases, attr)
+    For every tracked field the model gets the properties "<field>_original" and "<field>_changed". Relations are
+    compared by their id, their original object is only loaded when it is accessed and differs from the current one.
     """
 
-
-class BaseModelMixin(metaclass=CustomMeta):
-    pass
-
-
-class FieldTrackerMixin(object):
-
     track_fields = []
+    # attnames of track_fields, set up once per model class by setup_field_tracker
+    _tracked_attnames = ()
 
     def __init__(self, *args, **kwargs):
-        assert isinstance(self, models.Model) and isinstance(self, FieldTrackerMixin)
-
         super(FieldTrackerMixin, self).__init__(*args, **kwargs)
+        # read from the instance dict, the descriptor of a relation would load the related object
+        self.reset_tracked_fields()
+
+    def reset_tracked_fields(self):
+        # remember the current values as the original ones, e.g. after they were saved
+        values = self.__dict__
+        self._tracked_originals = dict((attname, values[attname] if attname in values else getattr(self, attname))
+                                       for attname in self._tracked_attnames)
+
+
+def _tracked_changed(attname):
+    def changed(self):
+        return self._tracked_originals[attname] != getattr(self, attname)
+    return property(changed)
+
+
+def _tracked_original(field, is_object):
+    def original(self):
+        value = self._tracked_originals[field.attname]
+        if not is_object:
+            return value
+        if value == getattr(self, field.attname):
+            return getattr(self, field.name)
+        if value is None:
+            return None
+        return field.remote_field.model._base_manager.get(**{field.target_field.attname: value})
+    return property(original)
+
+
+@receiver(class_prepared)
+def setup_field_tracker(sender, **kwargs):
+    if not issubclass(sender, FieldTrackerMixin):
+        return
+    attnames = []
+    for name in sender.track_fields:
+        field = sender._meta.get_field(name)
+        attnames.append(field.attname)
+        setattr(sender, name + "_changed", _tracked_changed(field.attname))
+        setattr(sender, name + "_original", _tracked_original(field, field.is_relation and name == field.name))
+    sender._tracked_attnames = tuple(attnames)
+
+
+class LedgerVersion(models.Model):
+    """
+    Single row of counters incremented by changes of the ledger, shared by all processes.
 
-        def prop_gen(field_name):
-            def prop(me):
-                return getattr(me, '%s_original' % field_name) != getattr(me, field_name)
-            return property(prop)
+    version counts every change, pages derive their ETags from it. periods counts changes of the inventories, the
+    inventory index of every process compares it with the one it was loaded at. names counts changes of users and
+    products, cached invoice tables include their names.
+    """
+    version = models.BigIntegerField(default=0)
+    periods = models.BigIntegerField(default=0)
+    names = models.BigIntegerField(default=0)
+
+    @staticmethod
+    def bump(periods=False, names=False):
+        # runs in the transaction of the change, readers see the new version once it is committed
+        changes = {"version": F("version") + 1}
+        if periods:
+            changes["periods"] = F("periods") + 1
+        if names:
+            changes["names"] = F("names") + 1
+        if not LedgerVersion.objects.filter(pk=1).update(**changes):
+            LedgerVersion.objects.get_or_create(pk=1)
+            LedgerVersion.objects.filter(pk=1).update(**changes)
+
+    @staticmethod
+    def get():
+        return LedgerVersion.objects.filter(pk=1).values_list("version", flat=True).first() or 0
+
+    @staticmethod
+    def get_periods():
+        return LedgerVersion.objects.filter(pk=1).values_list("periods", flat=True).first() or 0
 
-        for field in self.track_fields:
-            setattr(self, '%s_original' % field, getattr(self, field))
-            # TODO: do this in meta...
-            setattr(self.__class__, field + "_changed", prop_gen(field))
+    @staticmethod
+    def get_names():
+        return LedgerVersion.objects.filter(pk=1).values_list("names", flat=True).first() or 0
 
 
 class InvoiceDependencies(object):
     def get_related_invoices(self):
         raise NotImplementedError()
 
-    def set_may_have_changed(self, kwargs):
-        inventory_ids = set([i.pk for i in self.get_related_invoices() if i])
+    def get_related_products(self):
+        # products whose positions may have changed, None if all products may have changed
+        return None
+
+    @staticmethod
+    def mark_changed(changes):
+        """
+        :param changes: dict inventory id -> ids of products whose positions may have changed (None: all products)
+        """
+        inventory_ids = set(changes)
         if inventory_ids:
             if settings.DEBUG:
                 print("May have changed: " + str(inventory_ids))
+            DirtyProduct.mark(changes)
             Inventory.objects.filter(pk__in=inventory_ids, may_have_changed=False).update(may_have_changed=True)
+            transaction.on_commit(lambda: notify_recalculation(inventory_ids))
+
+    def set_may_have_changed(self, kwargs):
+        product_ids = self.get_related_products()
+        InvoiceDependencies.mark_changed(dict((i.pk, product_ids) for i in self.get_related_invoices() if i and i.pk))
 
     def delete(self, *args, **kwargs):
         assert isinstance(self, models.Model) and isinstance(self, InvoiceDependencies)
@@ -88,6 +158,7 @@ class InvoiceDependencies(object):
         ret = super(InvoiceDependencies, self).delete(*args, **kwargs)
         if set_may_have_changed:
             self.set_may_have_changed(kwargs)
+        LedgerVersion.bump()
         return ret
 
     def save(self, *args, **kwargs):
@@ -96,6 +167,7 @@ class InvoiceDependencies(object):
         ret = super(InvoiceDependencies, self).save(*args, **kwargs)
         if set_may_have_changed:
             self.set_may_have_changed(kwargs)
+        LedgerVersion.bump()
         return ret
 
 
@@ -141,6 +213,145 @@ class Product(models.Model):
         return "<Product: %s>" % self.name
 
 
+class InventoryIndex(object):
+    """
+    Dates of all inventories in ascending order, answers period lookups by reading only LedgerVersion.periods.
+
+    Saving or deleting an inventory invalidates the index and increments LedgerVersion.periods, so the index of
+    every process is reloaded once the change is committed. Until then lookups in this process query the
+    database, so the index never holds a rolled back change.
+
+    LedgerVersion.periods is read once per request or transaction, further lookups in it do not query the database.
+    Outside of both it is read on every lookup.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = 0
+        # ((version, LedgerVersion.periods), dates, ids)
+        self._index = None
+        # connections with uncommitted inventory changes
+        self._uncommitted = set()
+        # connection: (LedgerVersion.periods, on_commit callback dropping it, None if read for the request)
+        self._read_periods = {}
+        # connections serving a request
+        self._requests = set()
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+
+    def changed(self):
+        LedgerVersion.bump(periods=True)
+        connection = connections[DEFAULT_DB_ALIAS]
+        self._read_periods.pop(connection, None)
+        with self._lock:
+            self._version += 1
+            if connection.in_atomic_block:
+                self._uncommitted.add(connection)
+        transaction.on_commit(lambda: self._committed(connection))
+
+    def _committed(self, connection):
+        self._read_periods.pop(connection, None)
+        with self._lock:
+            self._version += 1
+            self._uncommitted.discard(connection)
+
+    def request_started(self):
+        connection = connections[DEFAULT_DB_ALIAS]
+        self._read_periods.pop(connection, None)
+        self._requests.add(connection)
+
+    def request_finished(self):
+        connection = connections[DEFAULT_DB_ALIAS]
+        self._read_periods.pop(connection, None)
+        self._requests.discard(connection)
+
+    def _periods(self):
+        connection = connections[DEFAULT_DB_ALIAS]
+        read = self._read_periods.get(connection)
+        if read is not None:
+            periods, drop = read
+            # a rolled back transaction (or savepoint) discards the callback together with the value
+            if drop is None or any(func is drop for _, func in connection.run_on_commit):
+                return periods
+            del self._read_periods[connection]
+        periods = LedgerVersion.get_periods()
+        if connection.in_atomic_block:
+            def drop():
+                self._read_periods.pop(connection, None)
+            transaction.on_commit(drop)
+            self._read_periods[connection] = (periods, drop)
+        elif connection in self._requests:
+            self._read_periods[connection] = (periods, None)
+        return periods
+
+    def _load(self):
+        # read before the inventories, a change committed in between only causes another reload
+        periods = self._periods()
+        with self._lock:
+            rolled_back = set(c for c in self._uncommitted if not c.in_atomic_block)
+            if rolled_back:
+                self._uncommitted -= rolled_back
+                self._version += 1
+            version, cacheable = (self._version, periods), not self._uncommitted
+            if self._index is not None and self._index[0] == version and cacheable:
+                return self._index
+        rows = list(Inventory.objects.order_by("date").values_list("date", "pk"))
+        index = (version, [d for d, _ in rows], [pk for _, pk in rows])
+        if cacheable:
+            with self._lock:
+                if self._version == version[0]:
+                    self._index = index
+        return index
+
+    @staticmethod
+    def _date(d):
+        return d.date() if isinstance(d, datetime) else d
+
+    def next(self, d, eq=True):
+        """
+        :return: (id, date) of the first inventory on (eq) or after d, None if there is none
+        """
+        _, dates, ids = self._load()
+        i = (bisect_left if eq else bisect_right)(dates, self._date(d))
+        return (ids[i], dates[i]) if i < len(ids) else None
+
+    def previous(self, d):
+        """
+        :return: (id, date) of the last inventory before d, None if there is none
+        """
+        _, dates, ids = self._load()
+        i = bisect_left(dates, self._date(d)) - 1
+        return (ids[i], dates[i]) if i >= 0 else None
+
+    def periods(self):
+        """
+        :return: (inventory id, date from, date until) of every period ordered by date, the open period last
+        """
+        _, dates, ids = self._load()
+        return list(zip(ids + [None], [None] + dates, dates + [None]))
+
+    def period_ids(self, dates):
+        # ids of the inventories closing the periods of the dates, None for dates after the last inventory
+        _, inventory_dates, ids = self._load()
+        return [ids[i] if i < len(ids) else None
+                for i in (bisect_left(inventory_dates, self._date(d)) for d in dates)]
+
+
+inventory_index = InventoryIndex()
+
+
+@receiver(request_started)
+def inventory_index_request_started(sender, **kwargs):
+    inventory_index.request_started()
+
+
+@receiver(request_finished)
+def inventory_index_request_finished(sender, **kwargs):
+    inventory_index.request_finished()
+
+
 class Inventory(InvoiceDependencies, models.Model, FieldTrackerMixin):
     track_fields = ["date"]
     date = models.DateField(default=date_now, unique=True)
@@ -151,22 +362,72 @@ class Inventory(InvoiceDependencies, models.Model, FieldTrackerMixin):
         return (([Inventory.get_next_inventory_by_date(self.date_original, False)] if self.date_changed else []) +
                 [self, next_inventory])
 
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        # the date field keeps the day only, a datetime of the same day is no move
+        self.date = InventoryIndex._date(self.date)
+        # consumptions move to other periods if inventories are added or moved
+        if self._state.adding:
+            dates = [self.date]
+        elif self.date_changed:
+            dates = [self.date_original, self.date]
+        else:
+            dates = []
+        ret = super(Inventory, self).save(*args, **kwargs)
+        if dates:
+            ConsumptionRollup.rebuild_periods(dates)
+        if len(dates) == 2:
+            # moved, the charts show the dates of the periods
+            ChartSeries.rebuild()
+        # a later move of this instance starts from the saved date
+        self.reset_tracked_fields()
+        return ret
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        date = self.date
+        ret = super(Inventory, self).delete(*args, **kwargs)
+        ConsumptionRollup.rebuild_periods([date])
+        # the invoices of the period are deleted with it
+        ChartSeries.rebuild()
+        return ret
+
+    @staticmethod
+    def _from_index(entry):
+        # only id and date are loaded, other fields are loaded from the database on access
+        if entry is not None:
+            return Inventory.from_db(DEFAULT_DB_ALIAS, ["id", "date"], entry)
+
     @staticmethod
     def get_next_inventory_by_date(d, eq=True):
-        try:
-            if eq:
-                return Inventory.objects.filter(date__gte=d).order_by("date").first()
-            else:
-                return Inventory.objects.filter(date__gt=d).order_by("date").first()
-        except Inventory.DoesNotExist:
-            pass
+        return Inventory._from_index(inventory_index.next(d, eq))
+
+    @staticmethod
+    def get_next_inventory_ids(dates):
+        return inventory_index.period_ids(dates)
 
     @staticmethod
     def get_prev_inventory_by_date(d):
-        try:
-            return Inventory.objects.filter(date__lt=d).order_by("-date").first()
-        except Inventory.DoesNotExist:
-            pass
+        return Inventory._from_index(inventory_index.previous(d))
+
+
+@receiver(post_save, sender=ProductType)
+@receiver(post_delete, sender=ProductType)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def bump_ledger_version(sender, instance, **kwargs):
+    # names of products, their types and users are shown on most pages, logins do not change them
+    if kwargs.get("update_fields") != frozenset(["last_login"]):
+        LedgerVersion.bump(names=True)
+
+
+@receiver(post_save, sender=Inventory)
+@receiver(post_delete, sender=Inventory)
+def invalidate_inventory_index(sender, instance, **kwargs):
+    if kwargs.get("created", True) or instance.date_changed:
+        inventory_index.changed()
 
 
 class ProductInventory(InvoiceDependencies, models.Model, FieldTrackerMixin):
@@ -174,12 +435,15 @@ class ProductInventory(InvoiceDependencies, models.Model, FieldTrackerMixin):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     count = models.IntegerField()
 
-    track_fields = ["inventory"]
+    track_fields = ["inventory", "product_id"]
 
     def get_related_invoices(self):
         return ((self.inventory.get_related_invoices() if self.inventory_changed else []) +
                 self.inventory_original.get_related_invoices())
 
+    def get_related_products(self):
+        return [self.product_id_original, self.product_id]
+
 
 class IncomingInvoice(InvoiceDependencies, FieldTrackerMixin, models.Model):
     # to verify every invoice is input correctly
@@ -188,10 +452,28 @@ class IncomingInvoice(InvoiceDependencies, FieldTrackerMixin, models.Model):
 
     track_fields = ["date"]
 
+    class Meta:
+        indexes = [models.Index(fields=["date"])]
+
     def get_related_invoices(self):
         return (([Inventory.get_next_inventory_by_date(self.date_original, True)] if self.date_changed else []) +
                 [Inventory.get_next_inventory_by_date(self.date, True)])
 
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        ret = super(IncomingInvoice, self).save(*args, **kwargs)
+        if self.date_changed:
+            # order of the orders may have changed
+            CumulativeOrder.rebuild(self.order_set.values_list("product_id", flat=True))
+        return ret
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        product_ids = list(self.order_set.values_list("product_id", flat=True))
+        ret = super(IncomingInvoice, self).delete(*args, **kwargs)
+        CumulativeOrder.rebuild(product_ids)
+        return ret
+
 
 class Order(InvoiceDependencies, models.Model, FieldTrackerMixin):
     incoming_invoice = models.ForeignKey(IncomingInvoice, on_delete=models.CASCADE)
@@ -199,7 +481,10 @@ class Order(InvoiceDependencies, models.Model, FieldTrackerMixin):
     each_cents = models.IntegerField()
     count = models.IntegerField()
 
-    track_fields = ["incoming_invoice"]
+    track_fields = ["incoming_invoice", "product_id"]
+
+    class Meta:
+        indexes = [models.Index(fields=["product", "incoming_invoice"])]
 
     def __str__(self):
         return "<Order: %s - %d>" % (self.product.name, self.count)
@@ -208,6 +493,70 @@ class Order(InvoiceDependencies, models.Model, FieldTrackerMixin):
         return ((self.incoming_invoice_original.get_related_invoices() if self.incoming_invoice_changed else []) +
                 self.incoming_invoice.get_related_invoices())
 
+    def get_related_products(self):
+        return [self.product_id_original, self.product_id]
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        ret = super(Order, self).save(*args, **kwargs)
+        CumulativeOrder.rebuild(self.get_related_products())
+        return ret
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        ret = super(Order, self).delete(*args, **kwargs)
+        CumulativeOrder.rebuild(self.get_related_products())
+        return ret
+
+
+class CumulativeOrder(models.Model):
+    """
+    Running totals of all orders of a product, one row per order sorted by incoming invoice date (first in, first out).
+
+    Rows of a product are inserted in that order, so sorting by primary key keeps it.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    date = models.DateField()
+    # price of this order
+    each_cents = models.IntegerField()
+    # ordered quantity and cost of this and all previous orders of the product
+    count = models.BigIntegerField()
+    cents = models.BigIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=["product", "date"])]
+
+    @staticmethod
+    def rebuild(product_ids=None):
+        """
+        :param product_ids: products to rebuild the running totals for, None for all products
+        """
+        orders = Order.objects.order_by("product_id", "incoming_invoice__date", "pk")
+        outdated = CumulativeOrder.objects.all()
+        if product_ids is not None:
+            product_ids = set(product_ids)
+            orders = orders.filter(product_id__in=product_ids)
+            outdated = outdated.filter(product_id__in=product_ids)
+        outdated.delete()
+
+        rows = []
+        last_product, count, cents = None, 0, 0
+        for product_id, date, order_count, each_cents in orders.values_list(
+                "product_id", "incoming_invoice__date", "count", "each_cents"):
+            if product_id != last_product:
+                last_product, count, cents = product_id, 0, 0
+            count += order_count
+            cents += order_count * each_cents
+            rows.append(CumulativeOrder(product_id=product_id, date=date, each_cents=each_cents,
+                                        count=count, cents=cents))
+        CumulativeOrder.objects.bulk_create(rows)
+
+    @staticmethod
+    def ordered_until(product, date):
+        # total count of all orders of the product until (and including) date
+        return (CumulativeOrder.objects.filter(product=product, date__lte=date).order_by("-pk")
+                .values_list("count", flat=True).first() or 0)
+
 
 class Consumption(InvoiceDependencies, models.Model, FieldTrackerMixin):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
@@ -216,15 +565,179 @@ class Consumption(InvoiceDependencies, models.Model, FieldTrackerMixin):
     date = models.DateField(default=date_now)
     issued_by = models.ForeignKey(User, on_delete=models.CASCADE,
                                   related_name="issued_consumption")
-    track_fields = ["date"]
+    track_fields = ["date", "product_id", "user_id"]
+
+    class Meta:
+        # period aggregations filter by product or user and a date range
+        indexes = [models.Index(fields=["product", "date"]),
+                   models.Index(fields=["user", "date"])]
 
     def __str__(self):
         return "<Consumption: %s - %s - %d>" % (self.user.username, self.product.name, self.count)
 
     def get_related_invoices(self):
-        return ((Inventory.get_next_inventory_by_date(self.date_original, True) if self.date_changed else []) +
+        return (([Inventory.get_next_inventory_by_date(self.date_original, True)] if self.date_changed else []) +
                 [Inventory.get_next_inventory_by_date(self.date, True)])
 
+    def get_related_products(self):
+        return [self.product_id_original, self.product_id]
+
+    def get_rollup_keys(self):
+        return [(self.date_original, self.product_id_original, self.user_id_original),
+                (self.date, self.product_id, self.user_id)]
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        ret = super(Consumption, self).save(*args, **kwargs)
+        ConsumptionRollup.refresh(self.get_rollup_keys())
+        return ret
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        ret = super(Consumption, self).delete(*args, **kwargs)
+        ConsumptionRollup.refresh(self.get_rollup_keys())
+        return ret
+
+    @staticmethod
+    @transaction.atomic
+    def create_all(consumptions):
+        """
+        Insert many consumptions at once, the affected periods are marked as changed only once.
+        """
+        consumptions = list(consumptions)
+        Consumption.objects.bulk_create(consumptions)
+        changes = defaultdict(set)
+        for inventory_id, consumption in zip(Inventory.get_next_inventory_ids([c.date for c in consumptions]),
+                                             consumptions):
+            if inventory_id is not None:
+                changes[inventory_id].add(consumption.product_id)
+        InvoiceDependencies.mark_changed(changes)
+        ConsumptionRollup.refresh((c.date, c.product_id, c.user_id) for c in consumptions)
+        LedgerVersion.bump()
+        return consumptions
+
+
+class ConsumptionRollup(models.Model):
+    """
+    Listed consumptions of a user summed per billing period and product.
+
+    Kept up to date whenever consumptions or inventories are saved or deleted.
+    """
+    # inventory closing the period, None for consumptions after the last inventory
+    inventory = models.ForeignKey(Inventory, on_delete=models.CASCADE, null=True, blank=True)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    count = models.IntegerField()
+    last_date = models.DateField()
+
+    class Meta:
+        unique_together = ("inventory", "product", "user")
+
+    @staticmethod
+    def _aggregate(period, consumptions):
+        inventory_id, date_from, date_until = period
+        if date_from is not None:
+            consumptions = consumptions.filter(date__gt=date_from)
+        if date_until is not None:
+            consumptions = consumptions.filter(date__lte=date_until)
+        return [ConsumptionRollup(inventory_id=inventory_id, product_id=product_id, user_id=user_id,
+                                  count=count, last_date=last_date)
+                for product_id, user_id, count, last_date in
+                consumptions.values("product_id", "user_id").annotate(count=Sum("count"), last_date=Max("date"))
+                .order_by().values_list("product_id", "user_id", "count", "last_date")]
+
+    @staticmethod
+    def rebuild():
+        ConsumptionRollup.objects.all().delete()
+        ConsumptionRollup.objects.bulk_create(
+            [row for period in inventory_index.periods()
+             for row in ConsumptionRollup._aggregate(period, Consumption.objects.all())])
+
+    @staticmethod
+    def rebuild_periods(dates):
+        """
+        Split the consumptions again after inventories were added, moved or deleted, only the periods around the
+        inventories' dates are rebuilt.
+
+        :param dates: dates inventories were added at, moved from or to or deleted at
+        """
+        periods = inventory_index.periods()
+        dates_until = [date_until for _, _, date_until in periods[:-1]]
+        affected = set()
+        for date in dates:
+            date = InventoryIndex._date(date)
+            i = bisect_left(dates_until, date)
+            affected.add(i)
+            if i < len(dates_until) and dates_until[i] == date:
+                # the following period was split off at or extended to the inventory
+                affected.add(i + 1)
+
+        inventory_ids = [periods[i][0] for i in affected]
+        outdated = Q(inventory_id__in=[pk for pk in inventory_ids if pk is not None])
+        if None in inventory_ids:
+            outdated |= Q(inventory_id__isnull=True)
+        ConsumptionRollup.objects.filter(outdated).delete()
+        ConsumptionRollup.objects.bulk_create([row for i in sorted(affected)
+                                               for row in ConsumptionRollup._aggregate(periods[i],
+                                                                                       Consumption.objects.all())])
+
+    @staticmethod
+    def refresh(keys):
+        """
+        :param keys: (date, product id, user id) of consumptions that were added, changed or deleted
+        """
+        periods = inventory_index.periods()
+        dates_until = [date_until for _, _, date_until in periods[:-1]]
+        affected = defaultdict(set)
+        for date, product_id, user_id in keys:
+            if date is not None and product_id is not None and user_id is not None:
+                affected[bisect_left(dates_until, date)].add((product_id, user_id))
+
+        for period_index, pairs in affected.items():
+            # all combinations of the affected products and users are recalculated
+            product_ids = set(product_id for product_id, _ in pairs)
+            user_ids = set(user_id for _, user_id in pairs)
+            ConsumptionRollup.objects.filter(inventory_id=periods[period_index][0], product_id__in=product_ids,
+                                             user_id__in=user_ids).delete()
+            ConsumptionRollup.objects.bulk_create(ConsumptionRollup._aggregate(
+                periods[period_index], Consumption.objects.filter(product_id__in=product_ids, user_id__in=user_ids)))
+
+
+class DirtyProduct(models.Model):
+    """
+    Product of an inventory's billing period whose invoice position has to be recalculated.
+
+    Every change adds a new marker, even if the product is marked already, so a recalculation can tell whether
+    the period changed while it was computing (markers it did not read).
+    """
+    inventory = models.ForeignKey(Inventory, on_delete=models.CASCADE)
+    # None: every position of the period has to be recalculated
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, null=True, blank=True)
+
+    @staticmethod
+    def mark(changes):
+        """
+        :param changes: dict inventory id -> product ids (None: all products)
+        """
+        DirtyProduct.objects.bulk_create([DirtyProduct(inventory_id=inventory_id, product_id=product_id)
+                                          for inventory_id, product_ids in changes.items()
+                                          for product_id in ([None] if product_ids is None else set(product_ids))])
+
+
+class OutgoingInvoiceQuerySet(models.QuerySet):
+
+    def update(self, **kwargs):
+        # invoices frozen or unfrozen in bulk change the latest frozen invoices of their chains
+        if "is_frozen" not in kwargs:
+            return super(OutgoingInvoiceQuerySet, self).update(**kwargs)
+        with transaction.atomic():
+            chain_root_ids = set(self.values_list("chain_root_id", flat=True))
+            rows = super(OutgoingInvoiceQuerySet, self).update(**kwargs)
+            OutgoingInvoice.update_latest_frozen(chain_root_ids)
+            LedgerVersion.bump()
+            ChartSeries.rebuild()
+        return rows
+
 
 class OutgoingInvoice(models.Model, FieldTrackerMixin):
 
@@ -238,14 +751,26 @@ class OutgoingInvoice(models.Model, FieldTrackerMixin):
     profit = models.IntegerField(default=0)
 
     is_frozen = models.BooleanField(default=False)
+    # incremented whenever the positions are recalculated, cached invoice data is keyed by pk and version
+    version = models.IntegerField(default=0)
     correction_of = models.OneToOneField("main.OutgoingInvoice", null=True, blank=True, related_name="corrected_by",
                                          on_delete=models.CASCADE, default=None)
-
-    objects = FilteredManager((Q(corrected_by=None) | Q(corrected_by__is_frozen=False)) & Q(is_frozen=True))
-    objects_all = models.Manager()
-    objects_initial = FilteredManager(Q(correction_of=None, is_frozen=True))
-    objects_temporary = FilteredManager(Q(is_frozen=False))
-    objects_latest = FilteredManager(Q(is_frozen=True) & (Q(corrected_by=None) | Q(corrected_by__is_frozen=False)))
+    # correction chain, kept by save: first invoice of the chain and number of corrections up to this invoice
+    chain_root = models.ForeignKey("main.OutgoingInvoice", null=True, blank=True, related_name="+",
+                                   on_delete=models.CASCADE)
+    chain_position = models.IntegerField(default=0)
+    # frozen and not corrected by another frozen invoice
+    is_latest_frozen = models.BooleanField(default=False, db_index=True)
+
+    objects = FilteredManager(Q(is_latest_frozen=True), OutgoingInvoiceQuerySet)
+    objects_all = OutgoingInvoiceQuerySet.as_manager()
+    objects_initial = FilteredManager(Q(correction_of=None, is_frozen=True), OutgoingInvoiceQuerySet)
+    objects_temporary = FilteredManager(Q(is_frozen=False), OutgoingInvoiceQuerySet)
+    objects_latest = FilteredManager(Q(is_latest_frozen=True), OutgoingInvoiceQuerySet)
+
+    class Meta:
+        indexes = [models.Index(fields=["inventory", "is_frozen"]),
+                   models.Index(fields=["chain_root", "chain_position"])]
 
     @property
     def diff_euro(self):
@@ -258,20 +783,15 @@ class OutgoingInvoice(models.Model, FieldTrackerMixin):
     def total_euro(self):
         return self.total / 100.
 
+    def chain(self):
+        # all invoices of the correction chain, latest first
+        return OutgoingInvoice.objects_all.filter(chain_root_id=self.chain_root_id).order_by("-chain_position")
+
     def correction_of_iterator(self):
-        invoice = self.correction_of
-        while invoice:
-            yield invoice
-            invoice = invoice.correction_of
+        return self.chain().filter(chain_position__lt=self.chain_position)
 
     def corrected_by_iterator(self):
-        invoice = self
-        while invoice:
-            try:
-                invoice = invoice.corrected_by
-            except OutgoingInvoice.DoesNotExist:
-                return None
-            yield invoice
+        return self.chain().filter(chain_position__gt=self.chain_position).order_by("chain_position")
 
     @property
     def is_temporary(self):
@@ -292,10 +812,49 @@ class OutgoingInvoice(models.Model, FieldTrackerMixin):
         return OutgoingInvoice.objects_all.filter(
             ~Q(total=F("correction_of__total")) & Q(correction_of__is_frozen=True, is_frozen=False))
 
+    @staticmethod
+    def update_latest_frozen(chain_root_ids=None):
+        """
+        Recalculate is_latest_frozen of the given chains, of all chains if None.
+        """
+        chains = OutgoingInvoice.objects_all.all()
+        if chain_root_ids is not None:
+            chains = chains.filter(chain_root_id__in=chain_root_ids)
+        chains.filter(is_latest_frozen=True).update(is_latest_frozen=False)
+        chains.filter(is_frozen=True).exclude(corrected_by__is_frozen=True).update(is_latest_frozen=True)
+
+    @transaction.atomic
     def save(self, *args, **kwargs):
-        if self.is_frozen and self.is_frozen != self.is_frozen_original:
-                self.date = datetime_now_tz()
+        adding = self._state.adding
+        # frozen or unfrozen, a new frozen invoice counts as frozen
+        frozen_changed = self.is_frozen_changed or (adding and self.is_frozen)
+        if self.is_frozen and self.is_frozen_changed:
+            self.date = datetime_now_tz()
+        if adding and self.correction_of_id is not None:
+            self.chain_root_id = self.correction_of.chain_root_id
+            self.chain_position = self.correction_of.chain_position + 1
         super(OutgoingInvoice, self).save(*args, **kwargs)
+        if self.chain_root_id is None:
+            self.chain_root_id = self.pk
+            OutgoingInvoice.objects_all.filter(pk=self.pk).update(chain_root_id=self.pk)
+        if adding or frozen_changed:
+            OutgoingInvoice.update_latest_frozen([self.chain_root_id])
+            self.is_latest_frozen = OutgoingInvoice.objects_all.get(pk=self.pk).is_latest_frozen
+        LedgerVersion.bump()
+        if frozen_changed:
+            # the invoice (or the correction of an approved invoice) is now shown in the charts, or no longer
+            ChartSeries.rebuild()
+        self.reset_tracked_fields()
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        ret = super(OutgoingInvoice, self).delete(*args, **kwargs)
+        OutgoingInvoice.update_latest_frozen([self.chain_root_id])
+        LedgerVersion.bump()
+        if self.is_frozen:
+            # the corrected invoice, if frozen, is shown instead
+            ChartSeries.rebuild()
+        return ret
 
 
 class OutgoingInvoiceProductPosition(models.Model):
@@ -316,3 +875,65 @@ class OutgoingInvoiceProductUserPosition(models.Model):
     count = models.IntegerField()
 
 
+class ChartSeries(models.Model):
+    """
+    Series of the charts page, one value per billing period of the latest frozen invoices.
+
+    Stored as json, rebuilt whenever the latest frozen invoices change (an invoice is frozen or a frozen one
+    deleted), an inventory is moved or deleted or a product is added.
+    """
+    DATES = "dates"
+    PROFIT = "profit"
+    LOSS = "loss"
+
+    series = models.CharField(max_length=10)
+    # product of a loss series
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, null=True, blank=True)
+    # json list: dates as strings, profits in euro or losses in percent
+    values = models.TextField()
+
+    @staticmethod
+    def _loss(loss, total):
+        # infinite losses (nothing sold) are shown as 0 or 100 percent, depending on the amount lost
+        return abs(loss) if abs(loss) != float("+inf") else (0 if total < 100 else 100)
+
+    @staticmethod
+    def rebuild():
+        invoices = list(OutgoingInvoice.objects.order_by("inventory__date").values_list("pk", "inventory__date",
+                                                                                       "profit"))
+        columns = dict((pk, column) for column, (pk, _, _) in enumerate(invoices))
+        losses = OrderedDict((product_id, [0] * len(invoices))
+                             for product_id in Product.objects.order_by("pk").values_list("pk", flat=True))
+        for invoice_id, product_id, loss, total in OutgoingInvoiceProductPosition.objects.filter(
+                invoice__is_latest_frozen=True).values_list("invoice_id", "product_id", "loss", "total"):
+            losses[product_id][columns[invoice_id]] = ChartSeries._loss(loss, total)
+
+        ChartSeries.objects.all().delete()
+        ChartSeries.objects.bulk_create(
+            [ChartSeries(series=ChartSeries.DATES, values=json.dumps([str(d) for _, d, _ in invoices])),
+             ChartSeries(series=ChartSeries.PROFIT, values=json.dumps([p / 100 for _, _, p in invoices]))] +
+            [ChartSeries(series=ChartSeries.LOSS, product_id=product_id, values=json.dumps(values))
+             for product_id, values in losses.items()])
+
+    @staticmethod
+    def load():
+        """
+        :return: json of the dates, json of the profits and list of (product name, json of the losses)
+        """
+        dates, profits, losses = "[]", "[]", []
+        for series, name, values in ChartSeries.objects.order_by("pk").values_list("series", "product__name",
+                                                                                   "values"):
+            if series == ChartSeries.DATES:
+                dates = values
+            elif series == ChartSeries.PROFIT:
+                profits = values
+            else:
+                losses.append((name, values))
+        return dates, profits, losses
+
+
+@receiver(post_save, sender=Product)
+def add_product_chart_series(sender, instance, created, **kwargs):
+    # every product has a loss series, even before any of its invoices was frozen
+    if created:
+        ChartSeries.rebuild()
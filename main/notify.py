@@ -0,0 +1,101 @@
+"""
+Wakes the recalculation worker when the ledger changed.
+
+Writers send the ids of inventories that may have changed as a datagram to a unix socket the worker listens on.
+Without a socket (not configured or not supported by the platform) the worker falls back to polling.
+"""
+import os
+import select
+import socket
+import time
+
+from tallybill.tally_settings import RECALCULATE_SOCKET, RECALCULATE_COALESCE_SECONDS
+
+_SUPPORTED = hasattr(socket, "AF_UNIX")
+
+
+def notify_recalculation(inventory_ids, path=RECALCULATE_SOCKET):
+    # never fails: if nobody listens, the worker will find the changes on its next poll
+    if not path or not _SUPPORTED:
+        return
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(",".join(str(i) for i in sorted(inventory_ids)).encode(), path)
+    except OSError:
+        pass
+
+
+class ListenerRunning(Exception):
+    """
+    Another process is listening on the socket.
+    """
+
+
+def _listening(path):
+    # a datagram socket can only be connected to while its bound socket is open, a stale file refuses
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+class RecalculationListener(object):
+
+    def __init__(self, path=RECALCULATE_SOCKET, coalesce_seconds=RECALCULATE_COALESCE_SECONDS):
+        self._path = path if _SUPPORTED else None
+        self._coalesce_seconds = coalesce_seconds
+        self._socket = None
+        if self._path:
+            if os.path.exists(self._path):
+                if _listening(self._path):
+                    raise ListenerRunning("%s is in use, is another recalculation worker running?" % self._path)
+                os.unlink(self._path)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(self._path)
+
+    @property
+    def listening(self):
+        return self._socket is not None
+
+    def _receive(self, timeout):
+        readable, _, _ = select.select([self._socket], [], [], timeout)
+        if not readable:
+            return None
+        data = self._socket.recv(65536).decode()
+        return set(int(i) for i in data.split(",") if i)
+
+    def wait(self, timeout):
+        """
+        Block until a change is notified or the timeout is reached.
+
+        A burst of notifications is coalesced into a single wake up.
+
+        :return: set of notified inventory ids, None on timeout
+        """
+        if not self.listening:
+            time.sleep(min(timeout, 1.0))
+            return None
+        inventory_ids = self._receive(timeout)
+        if inventory_ids is None:
+            return None
+        deadline = time.monotonic() + self._coalesce_seconds
+        while True:
+            more = self._receive(max(0., deadline - time.monotonic()))
+            if more is None:
+                return inventory_ids
+            inventory_ids |= more
+
+    def wake(self):
+        notify_recalculation([], self._path)
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
@@ -0,0 +1,85 @@
+"""
+Connection setup for sqlite databases.
+
+Every new connection runs the pragmas configured in settings.SQLITE_PRAGMAS.
+"""
+import os
+import sqlite3
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection, connections
+
+from main.models import inventory_index
+
+# pragmas reported by effective_pragmas
+PRAGMAS = ("journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store")
+
+
+def apply_pragmas(connection, pragmas):
+    """
+    :param connection: django database connection
+    :param pragmas: dict pragma name -> value
+    """
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+
+
+def effective_pragmas(connection):
+    """
+    :return: OrderedDict pragma name -> value as reported by sqlite
+    """
+    pragmas = OrderedDict()
+    with connection.cursor() as cursor:
+        for name in PRAGMAS:
+            cursor.execute("PRAGMA %s" % name)
+            row = cursor.fetchone()
+            pragmas[name] = row[0] if row else None
+    return pragmas
+
+
+def configure_connection(sender, connection, **kwargs):
+    # receiver of connection_created
+    if connection.vendor == "sqlite" and getattr(settings, "SQLITE_PRAGMAS", None):
+        apply_pragmas(connection, settings.SQLITE_PRAGMAS)
+
+
+def copy_database(path):
+    """
+    :return: path of a temporary copy of the sqlite database at path
+    """
+    fd, copy = tempfile.mkstemp(suffix=".sqlite3")
+    os.close(fd)
+    source, target = sqlite3.connect(path), sqlite3.connect(copy)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+    return copy
+
+
+@contextmanager
+def switched_database(path, delete=True):
+    """
+    Run the default connection of every thread on another sqlite database file.
+
+    :param delete: remove the database file (and its WAL files) afterwards
+    """
+    database = connection.settings_dict["NAME"]
+    connections.close_all()
+    connection.settings_dict["NAME"] = path
+    inventory_index.invalidate()
+    try:
+        yield
+    finally:
+        connections.close_all()
+        connection.settings_dict["NAME"] = database
+        inventory_index.invalidate()
+        if delete:
+            for name in [path, path + "-wal", path + "-shm"]:
+                if os.path.exists(name):
+                    os.unlink(name)
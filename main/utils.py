@@ -1,9 +1,11 @@
 import numpy
 from datetime import date
 from django.contrib.auth.models import User
+from django.core.cache import cache
 
-from main.models import OutgoingInvoice, OutgoingInvoiceProductUserPosition
-from tallybill.tally_settings import LOSS_WARN_LEVEL, LOSS_ERROR_LEVEL, TEMPLATE_BASE_URL
+from main.ledger import IdIndex
+from main.models import OutgoingInvoice, OutgoingInvoiceProductUserPosition, Consumption, Product, LedgerVersion
+from tallybill.tally_settings import LOSS_WARN_LEVEL, LOSS_ERROR_LEVEL, TEMPLATE_BASE_URL, INVOICE_CACHE_SECONDS
 
 
 def add_default_view_data(request, data_dict, title, pre_breadcrumbs=None):
@@ -25,6 +27,40 @@ def parse_date(date_str):
     return date(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10]))
 
 
+def _parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_consumptions(rows, issued_by):
+    """
+    Validate submitted consumptions, users and products are looked up with one query each.
+
+    :param rows: list of (row, user id, product id, count) as submitted
+    :return: list of unsaved consumptions of the valid rows, list of (row, error message) of the others
+    """
+    users = User.objects.in_bulk(set(filter(None, (_parse_int(user) for _, user, _, _ in rows))))
+    products = Product.objects.in_bulk(set(filter(None, (_parse_int(product) for _, _, product, _ in rows))))
+    consumptions, errors = [], []
+    for row, user, product, count in rows:
+        if any(value in (None, "") for value in (user, product, count)):
+            errors.append((row, "user, product and count are required"))
+            continue
+        user, product, count = _parse_int(user), _parse_int(product), _parse_int(count)
+        if user not in users:
+            errors.append((row, "unknown user"))
+        elif product not in products:
+            errors.append((row, "unknown product"))
+        elif count is None or count < 0:
+            errors.append((row, "invalid count"))
+        else:
+            consumptions.append(Consumption(user=users[user], product=products[product], count=count,
+                                            issued_by=issued_by))
+    return consumptions, errors
+
+
 def get_loss_color(loss):
     if loss is None:
         return "green"
@@ -76,11 +112,12 @@ def get_invoice_data(invoice):
                   .values_list("user_id", "productinvoice__product__id", "count", "productinvoice__price_each")
                   .order_by("user__username"))
 
+    columns = IdIndex(product_ids)
     for user_id, product_id, count, price in user_query:
         if user_id != last_user[0]:
             last_user = [user_id, id_to_username[user_id]] + [0] * (len(product_ids) + 1)
             invoice_table.append(last_user)
-        last_user[product_ids.index(product_id) + 3] = count * price / 100.
+        last_user[columns.offset(product_id) + 3] = count * price / 100.
 
     for user in invoice_table:
         user[2] = sum(user[3:])
@@ -89,19 +126,20 @@ def get_invoice_data(invoice):
 
 
 def subtract_invoices(invoice1, invoice2):
-    invoice_table1, product_ids1, product_names1, product_loss1, product_price1 = get_invoice_data(invoice1)
-    invoice_table2, product_ids2, product_names2, product_loss2, product_price2 = get_invoice_data(invoice2)
+    invoice_table1, product_ids1, product_names1, product_loss1, product_price1 = get_cached_invoice_data(invoice1)
+    invoice_table2, product_ids2, product_names2, product_loss2, product_price2 = get_cached_invoice_data(invoice2)
 
+    products1, products2 = IdIndex(product_ids1), IdIndex(product_ids2)
     product_indices = list(merge_sorted(sorted(product_ids1), sorted(product_ids2),
-                                        inserted=lambda e: (None, product_ids2.index(e)),
-                                        missing=lambda e: (product_ids1.index(e), None),
-                                        kept=lambda e, e2: (product_ids1.index(e), product_ids2.index(e2))))
-    users1 = [u[0] for u in invoice_table1]
-    users2 = [u[0] for u in invoice_table2]
-    user_indices = list(merge_sorted(sorted(users1), sorted(users2),
-                                     inserted=lambda e: (None, users2.index(e)),
-                                     missing=lambda e: (users1.index(e), None),
-                                     kept=lambda e, e2: (users1.index(e), users2.index(e2))))
+                                        inserted=lambda e: (None, products2.offset(e)),
+                                        missing=lambda e: (products1.offset(e), None),
+                                        kept=lambda e, e2: (products1.offset(e), products2.offset(e2))))
+    users1 = IdIndex([u[0] for u in invoice_table1])
+    users2 = IdIndex([u[0] for u in invoice_table2])
+    user_indices = list(merge_sorted(sorted(u[0] for u in invoice_table1), sorted(u[0] for u in invoice_table2),
+                                     inserted=lambda e: (None, users2.offset(e)),
+                                     missing=lambda e: (users1.offset(e), None),
+                                     kept=lambda e, e2: (users1.offset(e), users2.offset(e2))))
     new_invoice_table = [[0] * (len(product_indices) + 3) for _ in range(len(user_indices))]
     for uid, (ui1, ui2) in enumerate(user_indices):
         if ui2 is not None:
@@ -136,3 +174,37 @@ def subtract_invoices(invoice1, invoice2):
     new_invoice_table = sorted(new_invoice_table, key=lambda a: a[1])
 
     return new_invoice_table, new_product_ids, new_product_names, new_product_loss, new_product_price
+
+
+def _cached_invoice_data(invoices, compute):
+    # invoices are keyed by pk and version, a recalculation increments the version of the temporary invoice.
+    # the tables include user and product names, renaming one changes the key of every invoice
+    key = "invoice-data:%d:" % LedgerVersion.get_names() + ":".join(
+        "%d-%d" % (invoice.pk, invoice.version) for invoice in invoices)
+    data = cache.get(key)
+    if data is None:
+        data = compute()
+        # positions of frozen invoices never change
+        cache.set(key, data, None if all(invoice.is_frozen for invoice in invoices) else INVOICE_CACHE_SECONDS)
+    return data
+
+
+def get_cached_invoice_data(invoice):
+    return _cached_invoice_data([invoice], lambda: get_invoice_data(invoice))
+
+
+def get_cached_invoice_difference(invoice1, invoice2):
+    return _cached_invoice_data([invoice1, invoice2], lambda: subtract_invoices(invoice1, invoice2))
+
+
+def get_invoice_chain(invoice):
+    """
+    Invoice with all its corrections and corrected invoices, loaded with a single query.
+
+    :return: list of invoices, latest correction first
+    """
+    chain = list(invoice.chain().select_related("inventory"))
+    for invoice, previous in zip(chain, chain[1:]):
+        # set the relation to avoid a query per hop
+        invoice.correction_of = previous
+    return chain
@@ -1,35 +1,45 @@
 #!/usr/bin/python
 # -*- coding: <utf-8> -*-
-import io
+import hashlib
 import json
 from json.decoder import JSONDecodeError
 import math
+import os
 import urllib.parse
+from collections import defaultdict
 from datetime import date, datetime, timedelta
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import authenticate, login as auth_login, logout as auth_logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.db import IntegrityError, models
-from django.db.models import Max, Min, F
+from django.db.models import Max, Min
 from django.db.models.aggregates import Sum
-from django.db.models.query_utils import Q
 from django.http import HttpResponseRedirect, HttpResponseNotFound, HttpResponseBadRequest
-from django.http.response import Http404, HttpResponse
+from django.http.response import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.views.decorators.http import etag
 
 # Create your views here.
 import numpy
 
-from main.billing import BillingPeriod, ProductInPeriod, outgoing_to_csv
-from main.models import OutgoingInvoice, Product, Consumption, Inventory, \
-    IncomingInvoice, ProductInventory, ProductType, OutgoingInvoiceProductPosition, Order, \
-    OutgoingInvoiceProductUserPosition
-from main.utils import parse_date, get_loss_color, get_inventory_dates, add_default_view_data, subtract_invoices, \
-    get_invoice_data
+from main.billing import BillingPeriod, ProductInPeriod, get_user_statement, stream_csv
+from main.instrumentation import BUCKETS_MS, stats
+from main.ledger import PeriodLedger, IdIndex
+from main.models import ChartSeries, LedgerVersion, OutgoingInvoice, Product, Consumption, Inventory, \
+    IncomingInvoice, ProductInventory, ProductType, Order
+from main.utils import parse_date, get_loss_color, get_inventory_dates, add_default_view_data, \
+    get_cached_invoice_data, get_cached_invoice_difference, get_invoice_chain, parse_consumptions
 from tallybill.tally_settings import TEMPLATE_BASE_URL
 
 
+def ledger_etag(request, *args, **kwargs):
+    # pages only change with the ledger, and depend on the user they are rendered for and on the csrf token of
+    # their forms, which changes when the user logs in again
+    csrf_cookie = request.META.get("CSRF_COOKIE", "")
+    return "%d-%d-%s" % (LedgerVersion.get(), request.user.pk, hashlib.sha1(csrf_cookie.encode()).hexdigest()[:12])
+
+
 @staff_member_required
 def admin_users(request):
     return render(request, 'admin/users.html', add_default_view_data(request, {
@@ -55,24 +65,41 @@ def admin_invoices_list(request):
 
 @staff_member_required
 def download_csv(request, pk):
-    invoice = OutgoingInvoice.objects_all.get(pk=pk)
-    buffer = io.StringIO()
-    outgoing_to_csv(invoice, buffer, request.GET.get("difference") is not None)
-    buffer.seek(0)
-    response = HttpResponse(buffer.getvalue(), content_type='text/csv')
+    invoice = OutgoingInvoice.objects_all.select_related("inventory").get(pk=pk)
+    difference = request.GET.get("difference") is not None
+    response = StreamingHttpResponse(stream_csv([invoice], difference), content_type='text/csv')
     response['Content-Disposition'] = ('attachment; filename=%s%s.csv' %
                                        (urllib.parse.quote(invoice.inventory.date.strftime("%Y%m%d")),
-                                        "diff" if request.GET.get("difference") is not None else ""))
+                                        "diff" if difference else ""))
+    return response
+
+
+@staff_member_required
+def download_csv_all(request):
+    # latest frozen invoice of every period, optionally of a single year only
+    invoices = OutgoingInvoice.objects.select_related("inventory", "correction_of").order_by("inventory__date")
+    year = request.GET.get("year")
+    if year:
+        try:
+            invoices = invoices.filter(inventory__date__year=int(year))
+        except ValueError:
+            return HttpResponseBadRequest("Invalid year")
+    difference = request.GET.get("difference") is not None
+    response = StreamingHttpResponse(stream_csv(invoices, difference), content_type='text/csv')
+    response['Content-Disposition'] = ('attachment; filename=%s%s.csv' %
+                                       (urllib.parse.quote(year or "invoices"), "diff" if difference else ""))
     return response
 
 @staff_member_required
+@etag(ledger_etag)
 def admin_invoice_detailed(request, invoice_date=None, pk=None):
     # fetch invoice data
     if pk is None:
         invoice = OutgoingInvoice.objects_all.filter(inventory__date=parse_date(invoice_date)).last()
     else:
         invoice = OutgoingInvoice.objects_all.get(inventory__date=parse_date(invoice_date), pk=pk)
-    invoice_chain = list(list(reversed(list(invoice.corrected_by_iterator()))) + [invoice] + list(invoice.correction_of_iterator()))
+    invoice_chain = get_invoice_chain(invoice)
+    invoice = [i for i in invoice_chain if i.pk == invoice.pk][0]
 
     latest_in_chain = invoice_chain[0]
     # TODO: what what if total is equal by chance...
@@ -93,14 +120,14 @@ def admin_invoice_detailed(request, invoice_date=None, pk=None):
         return HttpResponseRedirect(request.path)
 
     if invoice.correction_of_id is None:
-        invoice_table, product_ids, product_names, product_loss, product_price = get_invoice_data(invoice)
+        invoice_table, product_ids, product_names, product_loss, product_price = get_cached_invoice_data(invoice)
         product_price = ((i / 100., None) for i in product_price)
         product_loss = ((loss, get_loss_color(loss), None, None) for loss in product_loss)
     else:
         invoice_table_diff, product_ids_diff, product_names_diff, product_loss, product_price = \
-            subtract_invoices(invoice.correction_of, invoice)
+            get_cached_invoice_difference(invoice.correction_of, invoice)
         # for now only display total amounts (override differences)
-        invoice_table, product_ids, product_names, _, _ = get_invoice_data(invoice)
+        invoice_table, product_ids, product_names, _, _ = get_cached_invoice_data(invoice)
         product_loss = [product_loss[product_ids_diff.index(id_)] for id_ in product_ids]
         product_price = [product_price[product_ids_diff.index(id_)] for id_ in product_ids]
 
@@ -128,39 +155,36 @@ def admin_invoice_detailed(request, invoice_date=None, pk=None):
 
 
 @login_required
+@etag(ledger_etag)
 def schwund_charts(request):
-    if OutgoingInvoice.objects.count() != 0:
-        dates, profits = zip(*OutgoingInvoice.objects.all().order_by("inventory__date").values_list("inventory__date", "profit"))
-    else:
-        dates, profits = [], []
-    pnn = Product.objects.values_list("pk", "name")
-    products, pnames = zip(*pnn)
-    id_to_pname = dict(pnn)
-    losses = dict([(product, [0] * len(dates)) for product in products])
-    for dt, product, loss, total in (OutgoingInvoiceProductPosition.objects.filter((Q(invoice__corrected_by=None) | Q(invoice__corrected_by__is_frozen=False)) & Q(invoice__is_frozen=True))
-                              .values_list("invoice__inventory__date", "product", "loss", "total")):
-        if product == 4 and abs(loss) == float("+inf"):
-            print((loss, total, abs(loss) if abs(loss) != float("+inf") else (0 if total < 100 else 100)))
-        losses[product][dates.index(dt)] = abs(loss) if abs(loss) != float("+inf") else (0 if total < 100 else 100)
-    new_losses = []
-    for k in losses:
-        new_losses.append((id_to_pname[k], json.dumps(losses[k])))
+    # series are materialized whenever an invoice is frozen
+    dates, profits, losses = ChartSeries.load()
     return render(request, "charts.html", add_default_view_data(request, {
-        "labels_json": json.dumps([str(i) for i in dates]),
-        "losses_json": new_losses,
-        "gewinn_json": json.dumps([i / 100 for i in profits])
+        "labels_json": dates,
+        "losses_json": losses,
+        "gewinn_json": profits
     }, "Schwund u. Gewinn"))
 
 
 @login_required
+@etag(ledger_etag)
+def schwund_charts_data(request):
+    dates, profits, losses = ChartSeries.load()
+    # the stored json is embedded as is
+    return HttpResponse('{"labels": %s, "profit": %s, "losses": [%s]}' % (
+        dates, profits, ", ".join('{"product": %s, "values": %s}' % (json.dumps(name), values)
+                                  for name, values in losses)), content_type="application/json")
+
+
+@login_required
+@etag(ledger_etag)
 def user_consumptions(request):
     # TODO: more efficient
     user = request.user
     inventories = Inventory.objects.all().order_by("date")
     inventories = inventories.exclude(pk=inventories.first().pk)
     dates_new = inventories.values_list("date", flat=True)
-    table = ProductInPeriod.get_listed_consumptions_table(inventories, Product.objects.all(),
-                                                          Consumption.objects.filter(user=user))
+    table = ProductInPeriod.get_listed_consumptions_table(inventories, Product.objects.all(), user)
     consumptions_new = []
     for p_id, product_name in enumerate(Product.objects.all().values_list("name", flat=True)):
         product_consumptions = []
@@ -192,7 +216,7 @@ def login(request):
     else:
         return render(request, "login.html", add_default_view_data(request, {
             "users": (User.objects.filter(userextension__allow_login=True)
-                      .annotate(max_cons_date=Max('consumption__date'))
+                      .annotate(max_cons_date=Max('consumptionrollup__last_date'))
                       .order_by("-max_cons_date"))
         }, "Login"))
 
@@ -205,16 +229,16 @@ def logout(request):
 @staff_member_required
 def select_product(request):
     if request.method == "POST":
-        print(request.POST["json_data"])
         try:
-            users = json.loads(request.POST["json_data"])
-        except JSONDecodeError as e:
-            return Http404("Invalid data input")
-        for user, products in users.items():
-            user = User.objects.get(pk=int(user))
-            for product, count in products.items():
-                product = Product.objects.get(pk=int(product))
-                Consumption(product=product, user=user, count=count, issued_by=request.user).save()
+            rows = [(None, user, product, count)
+                    for user, products in json.loads(request.POST["json_data"]).items()
+                    for product, count in products.items()]
+        except (JSONDecodeError, AttributeError):
+            return HttpResponseBadRequest("Invalid data input")
+        consumptions, errors = parse_consumptions(rows, request.user)
+        if errors:
+            return HttpResponseBadRequest("Invalid data input")
+        Consumption.create_all(consumptions)
         if request.COOKIES.get("temp_login") == "true":
             auth_logout(request)
         response = HttpResponseRedirect(request.path)
@@ -228,33 +252,28 @@ def select_product(request):
 
 
 @login_required
+@etag(ledger_etag)
 def user_invoices(request):
-    dates_new = {}
-
-    if OutgoingInvoice.objects.count() != 0:
-        latest_inv_pk, latest_inv_date = list(zip(*list(OutgoingInvoice.objects.values_list("pk", "date"))))
-    else:
-        latest_inv_pk, latest_inv_date = [], []
-
-    for position in (OutgoingInvoiceProductUserPosition.objects
-                     .filter(user=request.user, productinvoice__invoice__in=latest_inv_pk)
-                     .order_by("productinvoice__invoice__date").annotate(invoice_date=F("productinvoice__invoice__inventory__date"))
-                     .prefetch_related("productinvoice")):
-        if position.invoice_date not in dates_new:
-            dates_new[position.invoice_date] = []
-        dates_new[position.invoice_date].append((
-            position.productinvoice.product.name, position.productinvoice.price_each / 100., position.count,
-            position.count * position.productinvoice.price_each / 100., position.productinvoice.loss,
-            get_loss_color(position.productinvoice.loss)
-        ))
+    before = None
+    if request.GET.get("before"):
+        try:
+            before = datetime.strptime(request.GET["before"], "%Y-%m-%d").date()
+        except ValueError:
+            return HttpResponseBadRequest("Invalid date")
+    statement, next_before = get_user_statement(request.user, before)
+    dates = [(invoice_date, [(name, price_each / 100., count, count * price_each / 100., loss, get_loss_color(loss))
+                             for name, price_each, count, loss in lines])
+             for invoice_date, lines in statement]
 
     return render(request, "user_abrechnung.html", add_default_view_data(request, {
-        "dates": sorted([(k, v) for k, v in dates_new.items() if v], reverse=True)
+        "dates": dates,
+        "next_before": next_before
     }, "Invoice, %s" % request.user.username))
 
 
 @staff_member_required
 def create_consumtions(request):
+    consumptions, errors = [], []
     if request.method == "POST":
         if "delete" in request.POST:
             Consumption.objects.get(pk=request.POST["id"]).delete()
@@ -270,21 +289,35 @@ def create_consumtions(request):
                         data[id] = {}
                     data[id][dk[5:]] = v
 
-            for v in data.values():
-                consumtion = Consumption(product=Product.objects.get(id=v["product"]),
-                            user=User.objects.get(id=v["user"]),
-                            count=v["count"],
-                            issued_by=request.user)
-                consumtion.save()
-            return HttpResponseRedirect(request.build_absolute_uri())
+            consumptions, errors = parse_consumptions(
+                [(row.lstrip("-"), v.get("user"), v.get("product"), v.get("count")) for row, v in data.items()],
+                request.user)
+            # nothing is saved until every row is valid, so the form can simply be submitted again
+            if not errors:
+                Consumption.create_all(consumptions)
+                return HttpResponseRedirect(request.build_absolute_uri())
     pz = 100
     p = int(request.GET["p"] if "p" in request.GET else 0)
     page_count = math.ceil(Consumption.objects.filter(issued_by=request.user).count() / pz)
 
+    users = list(User.objects.all())
+    products = list(Product.objects.all())
+    rows = [{"pk": -i - 1} for i in range(100)]
+    if errors:
+        # show the submitted rows again, unknown ids are shown as entered
+        user_names = dict((str(u.pk), u.username) for u in users)
+        product_names = dict((str(pr.pk), pr.name) for pr in products)
+        for row in rows:
+            values = data.get(str(row["pk"]), {})
+            row.update(values)
+            row["user_name"] = user_names.get(values.get("user"), values.get("user"))
+            row["product_name"] = product_names.get(values.get("product"), values.get("product"))
+
     return render(request, "admin/admin_create_cons.html", add_default_view_data(request, {
-        "range": [{"pk": -i - 1} for i in range(100)],
-        "products": Product.objects.all(),
-        "users": User.objects.all(),
+        "errors": errors,
+        "range": rows,
+        "products": products,
+        "users": users,
         "pages": range(page_count),
         "current_page": p,
         "consumptions": Consumption.objects.filter(issued_by=request.user)
@@ -294,6 +327,7 @@ def create_consumtions(request):
 
 
 @staff_member_required
+@etag(ledger_etag)
 def admin_inventory_list(request):
     inventories = Inventory.objects.order_by("date")
     products = Product.objects.order_by("name")
@@ -308,7 +342,6 @@ def admin_inventory_list(request):
 
 @staff_member_required
 def admin_inventory(request, year=None, month=None, day=None):
-    # TODO: must be more efficient
     # TODO: use default_object_post?
     if year is None:
         date_obj = None
@@ -333,9 +366,9 @@ def admin_inventory(request, year=None, month=None, day=None):
             return HttpResponseRedirect(TEMPLATE_BASE_URL + "inventories/")
 
         try:
-            inventory.date = datetime.strptime(request.POST["date"], "%d.%m.%Y")
+            inventory.date = datetime.strptime(request.POST["date"], "%d.%m.%Y").date()
         except ValueError:
-            inventory.date = datetime.now()
+            inventory.date = datetime.now().date()
         inventory.save()
         for name, values in request.POST.items():
             if name.startswith("inv-"):
@@ -351,32 +384,19 @@ def admin_inventory(request, year=None, month=None, day=None):
         # inventory.save()
         return HttpResponseRedirect(urllib.parse.urljoin(TEMPLATE_BASE_URL + "inventory/", inventory.date.strftime("%Y-%m-%d")))
 
+    products = list(Product.objects.order_by("name"))
+    bp = BillingPeriod(inventory)
+    ledger = PeriodLedger.load(inventory, bp.previous_inventory, [p.pk for p in products])
+    offsets = IdIndex(ledger.product_ids).offsets([p.pk for p in products])
+    columns = zip(ledger.counts[offsets].tolist(), ledger.expected_counts()[offsets].tolist(),
+                  ledger.loss()[offsets].tolist(), ledger.listed_consumption()[offsets].tolist(),
+                  ledger.real_consumption()[offsets].tolist())
+    products_by_type = defaultdict(list)
+    for product, (count, expected, loss, listed, real) in zip(products, columns):
+        products_by_type[product.product_type_id].append(
+            (product, count, expected, loss, listed, real, get_loss_color(loss)))
     for prod_type in ProductType.objects.all():
-        type_data = []
-        for product in prod_type.product_set.order_by("name"):
-            bp = BillingPeriod(inventory)
-            pip = ProductInPeriod(bp, product)
-            try:
-                product_inventory = product.productinventory_set.get(inventory=inventory)
-            except ProductInventory.DoesNotExist as e:
-                product_inventory = None
-            previous = 0
-            try:
-                if bp.previous_billing_period is not None:
-                    previous = bp.previous_billing_period.inventory.productinventory_set.get(product=product).count
-            except ProductInventory.DoesNotExist as e:
-                previous = 0
-            expected = previous - pip.get_listed_consumptions() + pip.get_total_orders()
-            type_data.append((
-                product,
-                product_inventory.count if product_inventory else 0,
-                expected,
-                pip.get_loss(),
-                pip.get_listed_consumptions(),
-                pip.get_real_consumption(),
-                get_loss_color(pip.get_loss())
-            ))
-        data.append((prod_type, type_data))
+        data.append((prod_type, products_by_type[prod_type.pk]))
     return render(request, "admin/inventory.html", add_default_view_data(request, {
         "date": date_obj,
         "data": data
@@ -384,6 +404,21 @@ def admin_inventory(request, year=None, month=None, day=None):
     pre_breadcrumbs=[(TEMPLATE_BASE_URL + "inventories/", "Inventories")]))
 
 
+@staff_member_required
+def admin_stats(request):
+    if request.method == "POST":
+        stats.reset()
+        return HttpResponseRedirect(request.path)
+    return render(request, "admin/stats.html", add_default_view_data(request, {
+        "since": datetime.fromtimestamp(stats.since),
+        "pid": os.getpid(),
+        "buckets": BUCKETS_MS,
+        "views": stats.entries("view"),
+        "recalculations": stats.entries("recalculation"),
+        "slowest_queries": stats.slowest_queries()
+    }, "Admin - Statistics"))
+
+
 @staff_member_required
 def admin_products(request):
     return render(request, "admin/products.html", add_default_view_data(request, {
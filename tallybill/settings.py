@@ -40,10 +40,12 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.humanize',
     'django.contrib.staticfiles',
-    'main'
+    'main.apps.MainConfig'
 ]
 
 MIDDLEWARE = [
+    # first, to measure all other middleware as well
+    'main.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -93,6 +95,49 @@ DATABASES = {
     }
 }
 
+# computed invoice tables are cached (see main/utils.py), use a file or memcached backend to share the cache
+# between processes
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# pragmas run on every new sqlite connection (see main/sqlite.py), show the effective ones with
+# "manage.py sqlite_settings". Empty to keep sqlite's defaults.
+SQLITE_PRAGMAS = {
+    # readers (invoice pages, recalculation) do not block the tally writer and vice versa
+    'journal_mode': 'wal',
+    # in WAL mode only the last commits may be lost on power failure, the database never gets corrupted
+    'synchronous': 'normal',
+    # page cache, negative values are KiB
+    'cache_size': -64000,
+    # read the database through a memory map of up to 256 MiB
+    'mmap_size': 256 * 1024 * 1024,
+    # temporary tables and indices of sorts and groupings in memory
+    'temp_store': 'memory',
+}
+
+
+# Latency and queries of every view and recalculation are logged as json lines (see main/instrumentation.py)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'main.instrumentation': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
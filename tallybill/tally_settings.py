@@ -1,4 +1,5 @@
 # settings
+import os
 
 TEMPLATE_BASE_URL = "/"
 
@@ -6,3 +7,23 @@ PROFIT_FACTOR = 1.0
 PROFIT_FIXED_CENTS = 5
 LOSS_ERROR_LEVEL = 0.15
 LOSS_WARN_LEVEL = 0.07
+
+# unix socket the recalculation worker is woken up through, None to poll the database every second
+RECALCULATE_SOCKET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "recalculate.sock")
+# notifications arriving within this time after the first one are handled together
+RECALCULATE_COALESCE_SECONDS = 0.2
+# check for changes at least this often, even if no notification arrived
+RECALCULATE_IDLE_SECONDS = 60
+# recalculations of a period that changed meanwhile or found the database locked are repeated this often,
+# waiting RECALCULATE_RETRY_SECONDS (doubled on every attempt) in between
+RECALCULATE_ATTEMPTS = 5
+RECALCULATE_RETRY_SECONDS = 0.1
+
+# number of slowest queries kept per request and shown on the stats page
+STATS_SLOWEST_QUERIES = 10
+
+# cached data of temporary invoices expires after this time, frozen invoices are cached forever
+INVOICE_CACHE_SECONDS = 24 * 60 * 60
+
+# invoices per page of a user's invoice statement
+STATEMENT_PAGE_INVOICES = 12
@@ -0,0 +1,50 @@
+import os
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.models import Sum
+from django.test import TestCase
+
+from main.benchmark import LedgerGenerator, run_benchmark
+from main.models import Consumption, ConsumptionRollup, Inventory, ProductInventory
+
+
+class BenchmarkTest(TestCase):
+
+    def test_generated_ledger(self):
+        admin = User.objects.create(username="admin", is_staff=True)
+        inventories = LedgerGenerator(users=5, products=4, years=1, consumptions=600).generate(admin)
+        self.assertEqual(len(inventories), 13)
+        self.assertEqual(list(Inventory.objects.order_by("date")), inventories)
+        self.assertEqual(Consumption.objects.count(), 600)
+        self.assertFalse(ProductInventory.objects.filter(count__lt=0).exists())
+        self.assertEqual(ConsumptionRollup.objects.aggregate(Sum("count")),
+                         {"count__sum": Consumption.objects.aggregate(Sum("count"))["count__sum"]})
+
+    def test_report(self):
+        report = run_benchmark(LedgerGenerator(users=5, products=4, years=1, consumptions=600), repeat=1)
+        self.assertEqual(list(report["operations"]), [
+            "generate", "calculate --all", "recalculate_temporary_invoices", "recalculate_temporary_invoices full",
+            "admin_inventory_list", "admin_invoice_detailed", "user_consumptions", "user_invoices",
+            "schwund_charts", "csv export"])
+        for result in report["operations"].values():
+            self.assertGreater(result["queries"], 0)
+            self.assertGreaterEqual(result["seconds"], result["query_seconds"])
+        self.assertEqual(report["ledger"]["consumptions"], 601)
+        self.assertEqual(report["construction"]["Consumption"]["instances"], 600)
+        for result in report["construction"].values():
+            self.assertEqual(result["queries"], 0)
+
+    def test_existing_database_kept(self):
+        fd, path = tempfile.mkstemp(suffix=".sqlite3")
+        os.write(fd, b"data")
+        os.close(fd)
+        try:
+            with self.assertRaises(CommandError):
+                call_command("benchmark", database=path, consumptions=10)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"data")
+        finally:
+            os.unlink(path)
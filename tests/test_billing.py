@@ -0,0 +1,522 @@
+import datetime
+import math
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction, OperationalError
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from main.billing import BillingPeriod, ProductInPeriod, recalculate_all
+from main.ledger import PeriodLedger
+from main.models import Product, ProductType, IncomingInvoice, Order, Consumption, Inventory, ProductInventory, \
+    ConsumptionRollup, CumulativeOrder, inventory_index, OutgoingInvoice, OutgoingInvoiceProductPosition, \
+    OutgoingInvoiceProductUserPosition, DirtyProduct, LedgerVersion
+from tallybill.tally_settings import PROFIT_FACTOR, PROFIT_FIXED_CENTS
+
+
+class LedgerData(object):
+
+    def __init__(self):
+        self.admin = User.objects.create(username="admin", is_staff=True)
+        self.users = [User.objects.create(username="User%d" % i) for i in range(3)]
+
+        drinks = ProductType.objects.create(name="Drinks")
+        self.water, self.soda, self.beer, self.juice, self.cola = [
+            Product.objects.create(name=name, product_type=drinks)
+            for name in ["Water", "Soda", "Beer", "Juice", "Cola"]]
+
+        for date, orders in [
+            (datetime.date(2019, 1, 1), [(self.soda, 20, 20), (self.beer, 24, 80), (self.cola, 6, 50)]),
+            (datetime.date(2019, 1, 15), [(self.beer, 24, 90), (self.water, 10, 30)]),
+            (datetime.date(2019, 2, 10), [(self.soda, 10, 25), (self.beer, 12, 100)]),
+            (datetime.date(2019, 3, 30), [(self.beer, 6, 120)]),
+        ]:
+            incoming_invoice = IncomingInvoice.objects.create(invoice_id=str(date), date=date)
+            for product, count, each_cents in orders:
+                Order.objects.create(incoming_invoice=incoming_invoice, product=product,
+                                     count=count, each_cents=each_cents)
+
+        for date, user, product, count in [
+            (datetime.date(2019, 1, 4), 0, self.beer, 4),
+            (datetime.date(2019, 1, 2), 0, self.soda, 6),
+            (datetime.date(2019, 1, 4), 1, self.beer, 4),
+            (datetime.date(2019, 1, 20), 2, self.beer, 3),
+            (datetime.date(2019, 1, 21), 2, self.beer, 10),
+            (datetime.date(2019, 2, 1), 1, self.soda, 7),
+            (datetime.date(2019, 2, 2), 1, self.water, 1),
+            (datetime.date(2019, 2, 3), 0, self.beer, 12),
+            (datetime.date(2019, 2, 20), 0, self.cola, 2),
+            (datetime.date(2019, 3, 1), 1, self.beer, 20),
+        ]:
+            Consumption.objects.create(date=date, user=self.users[user], product=product, count=count,
+                                       issued_by=self.admin)
+
+        self.inventories = []
+        for date, counts in [
+            (datetime.date(2019, 1, 20), [(self.beer, 35), (self.soda, 13), (self.water, 10), (self.juice, 2),
+                                          (self.cola, 5)]),
+            (datetime.date(2019, 2, 20), [(self.beer, 20), (self.soda, 15), (self.water, 8), (self.juice, 2)]),
+            (datetime.date(2019, 3, 20), [(self.beer, 1), (self.soda, 15), (self.water, 8), (self.juice, 2)]),
+        ]:
+            inventory = Inventory.objects.create(date=date)
+            for product, count in counts:
+                ProductInventory.objects.create(inventory=inventory, product=product, count=count)
+            self.inventories.append(inventory)
+
+
+def reference_avg_price(product):
+    # first in, first out by walking all orders
+    date_from = product.billing_period.date_from
+    consumed_before_period = 0
+    if date_from is not None:
+        consumed_before_period = (sum(Order.objects.filter(product=product.product, incoming_invoice__date__lte=date_from)
+                                      .values_list("count", flat=True)) -
+                                  (product.billing_period.previous_inventory.productinventory_set
+                                   .filter(product=product.product).values_list("count", flat=True).first() or 0))
+    remaining_consumptions = max(product.get_real_consumption(), 0)
+
+    orders = product.product.order_set.order_by("incoming_invoice__date", "pk").values_list("count", "each_cents")
+    quantities, prices = [list(c) for c in zip(*orders)] if orders else ([], [])
+    for i in range(len(quantities)):
+        if consumed_before_period > 0:
+            v = min(consumed_before_period, quantities[i])
+            consumed_before_period -= v
+            quantities[i] -= v
+        if consumed_before_period == 0:
+            v = min(quantities[i], remaining_consumptions)
+            quantities[i] = v
+            remaining_consumptions -= v
+    if sum(quantities) == 0:
+        return 0
+    return sum([quantities[i] * prices[i] for i in range(len(prices))]) / sum(quantities)
+
+
+def reference_positions(period):
+    # per product calculation as done before the vectorized ledger
+    positions = {}
+    for product in period.products:
+        pos_loss_factor = float(max(1.0, product.get_loss_factor()))
+        avg_price = reference_avg_price(product)
+        assert avg_price == product.get_avg_price_for_consumed()
+        if pos_loss_factor == math.inf:
+            each_cents = 0
+            each_no_profit = 0
+        else:
+            each_cents = int(avg_price * pos_loss_factor * PROFIT_FACTOR + PROFIT_FIXED_CENTS)
+            each_no_profit = int(avg_price * pos_loss_factor)
+        user_counts = list(product.get_user_consumptions())
+        product_total = sum(count for _, count in user_counts)
+        positions[product.product.pk] = (product.get_loss(), each_cents, product_total * each_cents,
+                                         product_total * each_cents - product_total * each_no_profit, user_counts)
+    return positions
+
+
+class CumulativeOrderTest(TestCase):
+
+    def setUp(self):
+        self.data = LedgerData()
+
+    def running_totals(self, product):
+        return list(CumulativeOrder.objects.filter(product=product).order_by("pk")
+                    .values_list("date", "count", "cents"))
+
+    def test_orders_are_accumulated(self):
+        self.assertEqual(self.running_totals(self.data.beer), [
+            (datetime.date(2019, 1, 1), 24, 24 * 80),
+            (datetime.date(2019, 1, 15), 48, 24 * 80 + 24 * 90),
+            (datetime.date(2019, 2, 10), 60, 24 * 80 + 24 * 90 + 12 * 100),
+            (datetime.date(2019, 3, 30), 66, 24 * 80 + 24 * 90 + 12 * 100 + 6 * 120)])
+        self.assertEqual(CumulativeOrder.ordered_until(self.data.beer, datetime.date(2019, 2, 9)), 48)
+        self.assertEqual(CumulativeOrder.ordered_until(self.data.beer, datetime.date(2018, 2, 9)), 0)
+
+    def test_running_totals_follow_changes(self):
+        incoming_invoice = IncomingInvoice.objects.get(date=datetime.date(2019, 3, 30))
+        incoming_invoice.date = datetime.date(2018, 12, 1)
+        incoming_invoice.save()
+        self.assertEqual(self.running_totals(self.data.beer)[:2], [
+            (datetime.date(2018, 12, 1), 6, 6 * 120),
+            (datetime.date(2019, 1, 1), 30, 6 * 120 + 24 * 80)])
+
+        order = incoming_invoice.order_set.get()
+        order.product = self.data.water
+        order.save()
+        self.assertEqual(self.running_totals(self.data.beer)[0], (datetime.date(2019, 1, 1), 24, 24 * 80))
+        self.assertEqual(self.running_totals(self.data.water)[0], (datetime.date(2018, 12, 1), 6, 6 * 120))
+
+        IncomingInvoice.objects.get(date=datetime.date(2019, 1, 15)).delete()
+        self.assertEqual(self.running_totals(self.data.water), [(datetime.date(2018, 12, 1), 6, 6 * 120)])
+        self.assertEqual([c for _, c, _ in self.running_totals(self.data.beer)], [24, 36])
+
+
+class FieldTrackerTest(TestCase):
+
+    def setUp(self):
+        self.data = LedgerData()
+
+    def test_loading_does_not_fetch_relations(self):
+        with CaptureQueriesContext(connection) as queries:
+            orders = list(Order.objects.all())
+            list(ProductInventory.objects.all())
+        self.assertEqual(len(queries), 2)
+        self.assertFalse(any(order.incoming_invoice_changed or order.product_id_changed for order in orders))
+
+    def test_changes_are_tracked(self):
+        order = Order.objects.get(product=self.data.water)
+        original = order.incoming_invoice
+        order.incoming_invoice = IncomingInvoice.objects.get(date=datetime.date(2019, 2, 10))
+        order.product = self.data.juice
+        self.assertTrue(order.incoming_invoice_changed)
+        self.assertEqual(order.incoming_invoice_original, original)
+        self.assertTrue(order.product_id_changed)
+        self.assertEqual(order.product_id_original, self.data.water.pk)
+
+        order.incoming_invoice = original
+        self.assertFalse(order.incoming_invoice_changed)
+        self.assertIs(order.incoming_invoice_original, original)
+
+    def test_new_instances(self):
+        invoice = OutgoingInvoice(inventory=self.data.inventories[0], is_frozen=False)
+        self.assertFalse(invoice.is_frozen_changed)
+        invoice.is_frozen = True
+        self.assertTrue(invoice.is_frozen_changed)
+        self.assertFalse(invoice.is_frozen_original)
+
+
+class ConsumptionRollupTest(TestCase):
+
+    def setUp(self):
+        self.data = LedgerData()
+
+    def rollup(self):
+        return sorted(ConsumptionRollup.objects.values_list("inventory__date", "product_id", "user_id",
+                                                            "count", "last_date"), key=str)
+
+    def assertRollupUpToDate(self):
+        inventory_dates = sorted(Inventory.objects.values_list("date", flat=True))
+        expected = {}
+        for date, product_id, user_id, count in Consumption.objects.values_list("date", "product", "user", "count"):
+            period = next((d for d in inventory_dates if date <= d), None)
+            total, last_date = expected.get((period, product_id, user_id), (0, date))
+            expected[(period, product_id, user_id)] = (total + count, max(last_date, date))
+        self.assertEqual(self.rollup(), sorted((k + v for k, v in expected.items()), key=str))
+
+    def test_consumptions_are_rolled_up(self):
+        beer, user0 = self.data.beer.pk, self.data.users[0].pk
+        rows = self.rollup()
+        self.assertIn((datetime.date(2019, 1, 20), beer, user0, 4, datetime.date(2019, 1, 4)), rows)
+        self.assertIn((datetime.date(2019, 2, 20), beer, user0, 12, datetime.date(2019, 2, 3)), rows)
+        self.assertEqual(sum(r[3] for r in rows), sum(Consumption.objects.values_list("count", flat=True)))
+
+    def test_rollup_follows_consumptions(self):
+        consumption = Consumption.objects.get(date=datetime.date(2019, 2, 3))
+        consumption.date = datetime.date(2019, 3, 2)
+        consumption.product = self.data.soda
+        consumption.save()
+        self.assertRollupUpToDate()
+        Consumption.objects.create(date=datetime.date(2019, 4, 1), user=self.data.users[2], product=self.data.beer,
+                                   count=3, issued_by=self.data.admin)
+        self.assertIn((None, self.data.beer.pk, self.data.users[2].pk, 3, datetime.date(2019, 4, 1)), self.rollup())
+        self.assertRollupUpToDate()
+        Consumption.objects.get(date=datetime.date(2019, 1, 20)).delete()
+        self.assertRollupUpToDate()
+
+    def test_rollup_follows_inventories(self):
+        Inventory.objects.create(date=datetime.date(2019, 2, 5))
+        self.assertRollupUpToDate()
+        inventory = self.data.inventories[1]
+        inventory.date = datetime.date(2019, 3, 1)
+        inventory.save()
+        self.assertRollupUpToDate()
+        self.data.inventories[0].delete()
+        self.assertRollupUpToDate()
+
+    def test_inventory_moved_across_others(self):
+        inventory = self.data.inventories[0]
+        inventory.date = datetime.date(2019, 3, 10)
+        inventory.save()
+        self.assertRollupUpToDate()
+        # into the open period and back
+        inventory.date = datetime.date(2019, 4, 1)
+        inventory.save()
+        self.assertRollupUpToDate()
+        Consumption.objects.create(date=datetime.date(2019, 5, 1), user=self.data.users[0], product=self.data.beer,
+                                   count=1, issued_by=self.data.admin)
+        inventory.date = datetime.date(2019, 3, 25)
+        inventory.save()
+        self.assertRollupUpToDate()
+
+    def test_only_affected_periods_rebuilt(self):
+        first_period = set(ConsumptionRollup.objects.filter(inventory=self.data.inventories[0])
+                           .values_list("pk", flat=True))
+        Inventory.objects.create(date=datetime.date(2019, 3, 5))
+        self.assertRollupUpToDate()
+        self.assertEqual(set(ConsumptionRollup.objects.filter(inventory=self.data.inventories[0])
+                             .values_list("pk", flat=True)), first_period)
+
+
+class InventoryIndexTest(TransactionTestCase):
+
+    def setUp(self):
+        # flushing the database between tests does not send signals
+        inventory_index.invalidate()
+        self.data = LedgerData()
+
+    def test_lookups(self):
+        first, second, third = [i.pk for i in self.data.inventories]
+        self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 1, 20)).pk, first)
+        self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 1, 20), False).pk, second)
+        self.assertEqual(Inventory.get_next_inventory_by_date(datetime.datetime(2019, 2, 1, 12)).date,
+                         datetime.date(2019, 2, 20))
+        self.assertIsNone(Inventory.get_next_inventory_by_date(datetime.date(2019, 3, 21)))
+        self.assertEqual(Inventory.get_prev_inventory_by_date(datetime.date(2019, 2, 20)).pk, first)
+        self.assertIsNone(Inventory.get_prev_inventory_by_date(datetime.date(2019, 1, 20)))
+        self.assertEqual(Inventory.get_next_inventory_ids(
+            [datetime.date(2019, 1, 1), datetime.date(2019, 2, 20), datetime.date(2019, 3, 1),
+             datetime.date(2019, 4, 1)]), [first, second, third, None])
+
+    def test_lookups_are_cached(self):
+        inventory_index.periods()
+        with transaction.atomic():
+            # only the version of the periods is read, once per transaction
+            with self.assertNumQueries(1):
+                self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 2, 1)).pk,
+                                 self.data.inventories[1].pk)
+            with self.assertNumQueries(0):
+                self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 2, 1)).pk,
+                                 self.data.inventories[1].pk)
+                BillingPeriod(self.data.inventories[2]).previous_inventory
+                inventory_index.periods()
+
+    def test_periods_read_per_transaction(self):
+        inventory_index.periods()
+        with transaction.atomic():
+            inventory_index.periods()
+            Inventory.objects.filter(pk=self.data.inventories[1].pk).update(date=datetime.date(2019, 3, 10))
+            LedgerVersion.bump(periods=True)
+            # the change of another process is seen by the next transaction
+            self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 2, 25)).pk,
+                             self.data.inventories[2].pk)
+        self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 2, 25)).pk,
+                         self.data.inventories[1].pk)
+        try:
+            with transaction.atomic():
+                inventory_index.periods()
+                raise ValueError()
+        except ValueError:
+            pass
+        Inventory.objects.filter(pk=self.data.inventories[1].pk).update(date=datetime.date(2019, 2, 20))
+        LedgerVersion.bump(periods=True)
+        with transaction.atomic():
+            self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 2, 25)).pk,
+                             self.data.inventories[2].pk)
+
+    def test_changes_of_other_processes(self):
+        inventory_index.periods()
+        # a change committed by another process does not send signals in this one
+        Inventory.objects.filter(pk=self.data.inventories[1].pk).update(date=datetime.date(2019, 3, 10))
+        LedgerVersion.bump(periods=True)
+        self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 2, 25)).pk,
+                         self.data.inventories[1].pk)
+
+    def test_changes_invalidate(self):
+        inventory = Inventory.objects.create(date=datetime.date(2019, 2, 1))
+        self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 1, 25)).pk, inventory.pk)
+        inventory.date = datetime.date(2019, 3, 1)
+        inventory.save()
+        self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 2, 25)).pk, inventory.pk)
+        inventory.delete()
+        self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 2, 25)).pk,
+                         self.data.inventories[2].pk)
+
+    def test_rolled_back_changes_are_not_cached(self):
+        try:
+            with transaction.atomic():
+                inventory = Inventory.objects.create(date=datetime.date(2019, 2, 1))
+                self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 1, 25)).pk, inventory.pk)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(Inventory.get_next_inventory_by_date(datetime.date(2019, 1, 25)).pk,
+                         self.data.inventories[1].pk)
+
+
+class PeriodLedgerTest(TestCase):
+
+    def setUp(self):
+        self.data = LedgerData()
+
+    def test_positions_match_reference(self):
+        for inventory in self.data.inventories:
+            period = BillingPeriod(inventory)
+            ledger = PeriodLedger.load(period.inventory, period.previous_inventory)
+            positions = dict((p.product_id, (p.loss, p.price_each, p.total, p.profit, p.user_counts))
+                             for p in ledger.positions())
+            self.assertEqual(reference_positions(period), positions)
+
+    def test_unsaved_inventory(self):
+        # consumptions after the unsaved inventory's date do not belong to its period
+        Consumption.objects.create(date=datetime.date(2019, 4, 10), user=self.data.users[0], product=self.data.beer,
+                                   count=5, issued_by=self.data.admin)
+        Consumption.objects.create(date=datetime.date(2019, 3, 25), user=self.data.users[0], product=self.data.beer,
+                                   count=2, issued_by=self.data.admin)
+        ledger = PeriodLedger.load(Inventory(date=datetime.date(2019, 4, 1)), self.data.inventories[2],
+                                   [self.data.beer.pk])
+        self.assertEqual(ledger.listed_consumption().tolist(), [2])
+
+    def test_recalculate_temporary_invoices(self):
+        for inventory in self.data.inventories:
+            period = BillingPeriod(inventory)
+            period.recalculate_temporary_invoices()
+            invoice = period.invoices.get(is_frozen=False)
+            expected = reference_positions(period)
+            self.assertEqual(invoice.total, sum(p[2] for p in expected.values()))
+            self.assertEqual(invoice.profit, sum(p[3] for p in expected.values()))
+            for position in invoice.outgoinginvoiceproductposition_set.all():
+                loss, price_each, total, profit, user_counts = expected[position.product_id]
+                self.assertEqual((position.price_each, position.total, position.profit),
+                                 (price_each, total, profit))
+                self.assertEqual(sorted(position.outgoinginvoiceproductuserposition_set
+                                        .values_list("user_id", "count")), user_counts)
+            self.assertFalse(Inventory.objects.get(pk=inventory.pk).may_have_changed)
+
+    def test_constant_query_count(self):
+        inventory = self.data.inventories[1]
+        with CaptureQueriesContext(connection) as queries:
+            PeriodLedger.load(inventory, self.data.inventories[0]).positions()
+        num_queries = len(queries)
+
+        incoming_invoice = IncomingInvoice.objects.create(invoice_id="more", date=datetime.date(2019, 2, 1))
+        for i in range(10):
+            product = Product.objects.create(name="Product%d" % i)
+            Order.objects.create(incoming_invoice=incoming_invoice, product=product, count=10, each_cents=10)
+            ProductInventory.objects.create(inventory=inventory, product=product, count=5)
+            Consumption.objects.create(date=datetime.date(2019, 2, 5), user=self.data.users[0], product=product,
+                                       count=4, issued_by=self.data.admin)
+        with self.assertNumQueries(num_queries):
+            self.assertEqual(len(PeriodLedger.load(inventory, self.data.inventories[0]).positions()), 15)
+
+    def test_positions_inserted_in_bulk(self):
+        period = BillingPeriod(self.data.inventories[1])
+        with CaptureQueriesContext(connection) as queries:
+            period.recalculate_temporary_invoices()
+        inserts = [q["sql"] for q in queries if q["sql"].startswith("INSERT INTO \"main_outgoinginvoiceproduct")]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(period.invoices.get().outgoinginvoiceproductposition_set.count(), 5)
+
+    def test_only_dirty_products_recalculated(self):
+        inventory = self.data.inventories[1]
+        period = BillingPeriod(inventory)
+        period.recalculate_temporary_invoices()
+        invoice = period.invoices.get()
+        position_ids = dict(invoice.outgoinginvoiceproductposition_set.values_list("product_id", "pk"))
+        self.assertFalse(inventory.dirtyproduct_set.exists())
+
+        Consumption.objects.create(date=datetime.date(2019, 2, 4), user=self.data.users[2], product=self.data.beer,
+                                   count=2, issued_by=self.data.admin)
+        self.assertEqual(list(inventory.dirtyproduct_set.values_list("product_id", flat=True)), [self.data.beer.pk])
+
+        period.recalculate_temporary_invoices()
+        invoice.refresh_from_db()
+        new_position_ids = dict(invoice.outgoinginvoiceproductposition_set.values_list("product_id", "pk"))
+        self.assertNotEqual(position_ids.pop(self.data.beer.pk), new_position_ids.pop(self.data.beer.pk))
+        self.assertEqual(position_ids, new_position_ids)
+        expected = reference_positions(period)
+        self.assertEqual(invoice.total, sum(p[2] for p in expected.values()))
+        self.assertEqual(invoice.profit, sum(p[3] for p in expected.values()))
+        self.assertFalse(inventory.dirtyproduct_set.exists())
+
+    def test_recalculation_retried_on_concurrent_change(self):
+        inventory = self.data.inventories[1]
+        load = PeriodLedger.load
+
+        def load_and_change(*args, **kwargs):
+            ledger = load(*args, **kwargs)
+            if not Consumption.objects.filter(count=9).exists():
+                # tallied while the positions are computed
+                Consumption.objects.create(date=datetime.date(2019, 2, 4), user=self.data.users[2],
+                                           product=self.data.soda, count=9, issued_by=self.data.admin)
+            return ledger
+
+        period = BillingPeriod(inventory)
+        with mock.patch.object(PeriodLedger, "load", side_effect=load_and_change) as patched_load:
+            self.assertTrue(period.recalculate_temporary_invoices())
+        self.assertEqual(patched_load.call_count, 2)
+        expected = reference_positions(period)
+        self.assertEqual(period.get_temporary_invoice().total, sum(p[2] for p in expected.values()))
+        self.assertFalse(inventory.dirtyproduct_set.exists())
+
+    def test_recalculation_retried_on_locked_database(self):
+        period = BillingPeriod(self.data.inventories[1])
+        with mock.patch.object(period, "write_positions",
+                               side_effect=[OperationalError("database is locked"), None]) as patched:
+            self.assertTrue(period.recalculate_temporary_invoices())
+        self.assertEqual(patched.call_count, 2)
+        with mock.patch.object(period, "write_positions", side_effect=OperationalError("database is locked")):
+            with self.assertRaises(OperationalError):
+                period.recalculate_temporary_invoices()
+
+    def test_recalculate_all_in_parallel(self):
+        def invoice_positions():
+            return sorted(OutgoingInvoiceProductUserPosition.objects.values_list(
+                "productinvoice__invoice__inventory_id", "productinvoice__product_id", "productinvoice__price_each",
+                "productinvoice__total", "productinvoice__profit", "user_id", "count"))
+
+        for inventory in self.data.inventories:
+            BillingPeriod(inventory).recalculate_temporary_invoices()
+        expected = invoice_positions()
+        totals = list(OutgoingInvoice.objects_all.order_by("pk").values_list("total", "profit"))
+
+        OutgoingInvoiceProductPosition.objects.all().delete()
+        DirtyProduct.mark({self.data.inventories[0].pk: None})
+        recalculate_all(self.data.inventories, 2)
+        self.assertEqual(invoice_positions(), expected)
+        self.assertEqual(list(OutgoingInvoice.objects_all.order_by("pk").values_list("total", "profit")), totals)
+        self.assertFalse(DirtyProduct.objects.exists())
+        self.assertFalse(Inventory.objects.filter(may_have_changed=True).exists())
+
+
+class TableTest(TestCase):
+
+    def setUp(self):
+        self.data = LedgerData()
+        self.inventories = Inventory.objects.order_by("date")
+        self.products = Product.objects.order_by("name")
+
+    def column(self, product):
+        return list(self.products.values_list("pk", flat=True)).index(product.pk)
+
+    def test_total_orders_table(self):
+        table = ProductInPeriod.get_total_orders_table(self.inventories, self.products)
+        self.assertEqual(table[:, self.column(self.data.beer)].tolist(), [48, 12, 0])
+        self.assertEqual(table[:, self.column(self.data.soda)].tolist(), [20, 10, 0])
+
+    def test_product_inventory_count_table(self):
+        table, inventory_ids, product_ids = ProductInPeriod.get_product_inventory_count_table(
+            self.inventories, self.products)
+        self.assertEqual(inventory_ids, [i.pk for i in self.data.inventories])
+        self.assertEqual(table[:, self.column(self.data.beer)].tolist(), [35, 20, 1])
+        self.assertEqual(table[:, self.column(self.data.cola)].tolist(), [5, 0, 0])
+
+    def test_listed_consumptions_table(self):
+        table = ProductInPeriod.get_listed_consumptions_table(self.inventories, self.products)
+        self.assertEqual(table[:, self.column(self.data.beer)].tolist(), [11, 22, 20])
+        table = ProductInPeriod.get_listed_consumptions_table(
+            self.inventories, self.products, self.data.users[1])
+        self.assertEqual(table[:, self.column(self.data.beer)].tolist(), [4, 0, 20])
+        self.assertEqual(table[:, self.column(self.data.soda)].tolist(), [0, 7, 0])
+
+    def test_real_consumption_list(self):
+        table = ProductInPeriod.get_real_consumption_list(self.inventories, self.products)
+        self.assertEqual(table.shape, (3, 5))
+        for row, inventory in enumerate(self.data.inventories):
+            ledger = PeriodLedger.load(inventory, BillingPeriod(inventory).previous_inventory,
+                                       self.products.values_list("pk", flat=True))
+            real = ledger.real_consumption()
+            for product in self.products:
+                self.assertEqual(table[row, self.column(product)], real[list(ledger.product_ids).index(product.pk)])
+
+    def test_tables_for_product_subset(self):
+        products = Product.objects.filter(pk__in=[self.data.beer.pk, self.data.water.pk]).order_by("name")
+        self.assertEqual(ProductInPeriod.get_real_consumption_list(self.inventories, products).tolist(),
+                         [[13, 0], [27, 2], [19, 0]])
@@ -0,0 +1,41 @@
+from django.db import connection
+from django.test import TestCase
+
+from main.instrumentation import Histogram, QueryCounter, instrument, stats
+from main.models import Product
+
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        stats.reset()
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for ms in [1, 2, 3, 30, 4000]:
+            histogram.add(ms)
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.counts[0], 3)
+        self.assertEqual(histogram.percentile(50), 5)
+        self.assertEqual(histogram.percentile(80), 50)
+        self.assertEqual(histogram.percentile(100), 4000)
+        self.assertAlmostEqual(histogram.mean_ms, 807.2)
+
+    def test_query_counter_keeps_slowest(self):
+        counter = QueryCounter(slowest=2)
+        with connection.execute_wrapper(counter):
+            for i in range(5):
+                list(Product.objects.filter(pk=i))
+        self.assertEqual(counter.count, 5)
+        self.assertEqual(len(counter.slowest), 2)
+        self.assertLessEqual(sum(seconds for seconds, _ in counter.slowest), counter.seconds)
+
+    def test_instrument(self):
+        with instrument("recalculation", "2019-02-20"):
+            list(Product.objects.all())
+        with self.assertRaises(ValueError):
+            with instrument("recalculation", "2019-02-20"):
+                raise ValueError()
+        entry, = stats.entries("recalculation")
+        self.assertEqual((entry.name, entry.latency.count, entry.queries, entry.errors), ("2019-02-20", 2, 1, 1))
+        self.assertEqual(stats.entries("view"), [])
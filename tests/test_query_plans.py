@@ -0,0 +1,89 @@
+import datetime
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Sum
+from django.test import TestCase
+
+from main.models import Consumption, Order, OutgoingInvoice
+from main.sqlite import apply_pragmas, effective_pragmas
+from tests.test_billing import LedgerData
+
+
+class QueryPlanTest(TestCase):
+    """
+    hot billing queries must be served by the composite indexes instead of scanning tables
+    """
+
+    def setUp(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("EXPLAIN QUERY PLAN is specific to SQLite")
+        self.data = LedgerData()
+
+    def plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return " | ".join(row[-1] for row in cursor.fetchall())
+
+    @staticmethod
+    def index_name(model, fields):
+        return next(index.name for index in model._meta.indexes if index.fields == fields)
+
+    def assertUsesIndex(self, queryset, model, index_fields, fields):
+        """
+        :param index_fields: fields of the composite index the query has to use
+        :param fields: constraints the index is searched with
+        """
+        table = model._meta.db_table
+        plan = self.plan(queryset)
+        self.assertNotIn("SCAN %s" % table, plan.replace("SCAN TABLE", "SCAN"))
+        self.assertRegex(plan, r"SEARCH (TABLE )?%s USING (COVERING )?INDEX %s \(%s" % (
+            table, self.index_name(model, index_fields), re.escape(" AND ".join(fields))))
+
+    def test_consumptions_of_products_in_period(self):
+        consumptions = (Consumption.objects.filter(product_id__in=[self.data.beer.pk, self.data.soda.pk],
+                                                   date__gt=datetime.date(2019, 1, 20),
+                                                   date__lte=datetime.date(2019, 2, 20))
+                        .values("product_id", "user_id").annotate(consumed=Sum("count")))
+        self.assertUsesIndex(consumptions, Consumption, ["product", "date"], ["product_id=?", "date>?"])
+
+    def test_consumptions_of_user_in_period(self):
+        consumptions = Consumption.objects.filter(user=self.data.users[0], date__gt=datetime.date(2019, 1, 20),
+                                                  date__lte=datetime.date(2019, 2, 20))
+        self.assertUsesIndex(consumptions, Consumption, ["user", "date"], ["user_id=?", "date>?"])
+
+    def test_orders_of_product_in_period(self):
+        orders = Order.objects.filter(product=self.data.beer, incoming_invoice__date__gt=datetime.date(2019, 1, 20),
+                                      incoming_invoice__date__lte=datetime.date(2019, 2, 20))
+        self.assertUsesIndex(orders, Order, ["product", "incoming_invoice"], ["product_id=?"])
+
+    def test_temporary_invoice_of_inventory(self):
+        invoices = OutgoingInvoice.objects_all.filter(inventory=self.data.inventories[0], is_frozen=False)
+        self.assertUsesIndex(invoices, OutgoingInvoice, ["inventory", "is_frozen"], ["inventory_id=?", "is_frozen=?"])
+
+
+class SqlitePragmaTest(TestCase):
+    """
+    connections are set up with the configured pragmas
+    """
+
+    def setUp(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("pragmas are specific to SQLite")
+
+    def test_effective_pragmas(self):
+        pragmas = effective_pragmas(connection)
+        self.assertEqual(pragmas["journal_mode"], "wal")
+        self.assertEqual(pragmas["synchronous"], 1)
+        self.assertEqual(pragmas["cache_size"], settings.SQLITE_PRAGMAS["cache_size"])
+        self.assertEqual(pragmas["mmap_size"], settings.SQLITE_PRAGMAS["mmap_size"])
+        self.assertEqual(pragmas["temp_store"], 2)
+
+    def test_apply_pragmas(self):
+        try:
+            apply_pragmas(connection, {"cache_size": -1000})
+            self.assertEqual(effective_pragmas(connection)["cache_size"], -1000)
+        finally:
+            apply_pragmas(connection, {"cache_size": settings.SQLITE_PRAGMAS["cache_size"]})
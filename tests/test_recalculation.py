@@ -0,0 +1,57 @@
+import os
+import socket
+import tempfile
+import time
+from threading import Thread
+
+from django.test import SimpleTestCase
+
+from main.notify import ListenerRunning, RecalculationListener, notify_recalculation
+
+
+class RecalculationListenerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "recalculate.sock")
+        self.listener = RecalculationListener(self.path, coalesce_seconds=0.1)
+
+    def tearDown(self):
+        self.listener.close()
+        self.directory.cleanup()
+
+    def test_timeout_without_notification(self):
+        self.assertIsNone(self.listener.wait(0.05))
+
+    def test_notifications_are_coalesced(self):
+        for inventory_ids in [[1], [2, 3], [3]]:
+            notify_recalculation(inventory_ids, self.path)
+        self.assertEqual(self.listener.wait(1), {1, 2, 3})
+        self.assertIsNone(self.listener.wait(0.05))
+
+    def test_wake_interrupts_wait(self):
+        Thread(target=lambda: (time.sleep(0.05), self.listener.wake())).start()
+        begin = time.monotonic()
+        self.assertEqual(self.listener.wait(10), set())
+        self.assertLess(time.monotonic() - begin, 5)
+
+    def test_notify_without_listener(self):
+        notify_recalculation([1], os.path.join(self.directory.name, "nobody.sock"))
+
+    def test_second_listener_refused(self):
+        with self.assertRaises(ListenerRunning):
+            RecalculationListener(self.path)
+        notify_recalculation([1], self.path)
+        self.assertEqual(self.listener.wait(1), {1})
+
+    def test_stale_socket_replaced(self):
+        path = os.path.join(self.directory.name, "stale.sock")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.close()
+        listener = RecalculationListener(path, coalesce_seconds=0.1)
+        try:
+            notify_recalculation([2], path)
+            self.assertEqual(listener.wait(1), {2})
+        finally:
+            listener.close()
@@ -0,0 +1,358 @@
+import datetime
+import json
+import os
+import re
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from main.billing import BillingPeriod, ProductInPeriod, get_user_statement, get_user_sums
+from main.instrumentation import stats
+from main.models import Product, ProductType, Consumption, Inventory, ProductInventory, DirtyProduct, OutgoingInvoice, \
+    LedgerVersion, date_now, OutgoingInvoiceProductUserPosition
+from main.utils import get_invoice_data
+from tests.test_billing import LedgerData
+
+
+class ViewTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.data = LedgerData()
+        for inventory in self.data.inventories:
+            BillingPeriod(inventory).recalculate_temporary_invoices()
+        self.client.force_login(self.data.admin)
+
+    def test_inventories(self):
+        response = self.client.get("/inventories/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(re.findall(r'inventory/([0-9-]+)".*>([0-9]+) Einheiten', response.content.decode()),
+                         [("2019-03-20", "1"), ("2019-02-20", "10"), ("2019-01-20", "6")])
+
+    def test_invoice(self):
+        response = self.client.get("/invoice/2019-02-20/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([u[0] for u in response.context["users"]], ["User0", "User1", "User2"])
+        self.assertEqual(list(response.context["names"]), ["Beer", "Cola", "Juice", "Soda", "Water"])
+
+    def test_invoice_cached(self):
+        def view():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/invoice/2019-02-20/")
+            return response.context["users"], len([q for q in queries if "main_outgoinginvoiceproduct" in q["sql"]])
+
+        def expected():
+            return [u[1:] for u in get_invoice_data(BillingPeriod(self.data.inventories[1]).get_temporary_invoice())[0]]
+
+        users, position_queries = view()
+        self.assertEqual(users, expected())
+        self.assertGreater(position_queries, 0)
+        # the positions are not read again
+        self.assertEqual(view(), (users, 0))
+        # recalculated temporary invoices are not served from the cache
+        Consumption.objects.create(date=datetime.date(2019, 2, 4), user=self.data.users[2], product=self.data.beer,
+                                   count=5, issued_by=self.data.admin)
+        BillingPeriod(self.data.inventories[1]).recalculate_temporary_invoices()
+        self.assertNotEqual(expected(), users)
+        self.assertEqual(view()[0], expected())
+
+    def test_invoice_cached_renamed(self):
+        invoice = OutgoingInvoice.objects_all.get(inventory=self.data.inventories[1])
+        invoice.is_frozen = True
+        invoice.save()
+        self.assertIn("User0", [u[0] for u in self.client.get("/invoice/2019-02-20/").context["users"]])
+        user = self.data.users[0]
+        user.username = "Renamed"
+        user.save()
+        self.assertIn("Renamed", [u[0] for u in self.client.get("/invoice/2019-02-20/").context["users"]])
+
+    def test_invoice_correction(self):
+        OutgoingInvoice.objects_all.update(is_frozen=True)
+        Consumption.objects.create(date=datetime.date(2019, 2, 4), user=self.data.users[2], product=self.data.beer,
+                                   count=1, issued_by=self.data.admin)
+        BillingPeriod(self.data.inventories[1]).recalculate_temporary_invoices()
+        response = self.client.get("/invoice/2019-02-20/")
+        self.assertEqual(response.status_code, 200)
+        correction, corrected = response.context["invoice_chain"]
+        self.assertEqual(response.context["invoice"], correction)
+        self.assertEqual(correction.correction_of, corrected)
+        self.assertTrue(corrected.is_frozen)
+
+    def test_invoice_chain_latest_frozen(self):
+        inventory = self.data.inventories[1]
+        OutgoingInvoice.objects_all.update(is_frozen=True)
+        first = OutgoingInvoice.objects.get(inventory=inventory)
+        for count in [1, 2]:
+            Consumption.objects.create(date=datetime.date(2019, 2, 4), user=self.data.users[2],
+                                       product=self.data.beer, count=count, issued_by=self.data.admin)
+            BillingPeriod(inventory).recalculate_temporary_invoices()
+            correction = OutgoingInvoice.objects_all.get(inventory=inventory, is_frozen=False)
+            correction.is_frozen = True
+            correction.save()
+            self.assertEqual(OutgoingInvoice.objects.get(inventory=inventory), correction)
+
+        chain = list(correction.chain())
+        self.assertEqual([invoice.chain_position for invoice in chain], [2, 1, 0])
+        self.assertEqual(chain[-1], first)
+        self.assertEqual(set(invoice.chain_root_id for invoice in chain), {first.pk})
+        self.assertEqual([invoice.is_latest_frozen for invoice in chain], [True, False, False])
+
+        correction.delete()
+        self.assertEqual(OutgoingInvoice.objects.get(inventory=inventory), chain[1])
+        # unfreezing, one by one or in bulk
+        chain[1].is_frozen = False
+        chain[1].save()
+        self.assertEqual(OutgoingInvoice.objects.get(inventory=inventory), first)
+        OutgoingInvoice.objects_all.filter(inventory=inventory).update(is_frozen=False)
+        self.assertFalse(OutgoingInvoice.objects.filter(inventory=inventory).exists())
+        OutgoingInvoice.objects_all.filter(pk=first.pk).update(is_frozen=True)
+        self.assertEqual(OutgoingInvoice.objects.get(inventory=inventory), first)
+
+    def test_user_invoices(self):
+        OutgoingInvoice.objects_all.update(is_frozen=True)
+        self.client.force_login(self.data.users[1])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/user_invoices/")
+        self.assertEqual(response.status_code, 200)
+        dates = response.context["dates"]
+        self.assertEqual([d for d, _ in dates], [i.date for i in reversed(self.data.inventories)])
+        for d, lines in dates:
+            invoice = OutgoingInvoice.objects.get(inventory__date=d)
+            self.assertEqual(sum(line[3] for line in lines),
+                             get_user_sums([invoice])[invoice.pk][self.data.users[1].pk][1] / 100.)
+        # the positions are read with a single query, whatever the number of products
+        self.assertEqual(len([q for q in queries if "main_outgoinginvoiceproductuserposition" in q["sql"]]), 1)
+        self.assertEqual(self.client.get("/user_invoices/?before=2019-13-01").status_code, 400)
+
+    def test_user_statement_paging(self):
+        OutgoingInvoice.objects_all.update(is_frozen=True)
+        user = self.data.users[1]
+        statement, before = get_user_statement(user, count=2)
+        self.assertEqual([d for d, _ in statement], [datetime.date(2019, 3, 20), datetime.date(2019, 2, 20)])
+        self.assertEqual(before, datetime.date(2019, 2, 20))
+        statement, before = get_user_statement(user, before, count=2)
+        self.assertEqual([d for d, _ in statement], [datetime.date(2019, 1, 20)])
+        self.assertIsNone(before)
+        self.assertEqual(sum(len(lines) for _, lines in get_user_statement(user, count=None)[0]),
+                         OutgoingInvoiceProductUserPosition.objects.filter(user=user).count())
+
+    def test_charts(self):
+        for invoice in OutgoingInvoice.objects_all.exclude(inventory=self.data.inventories[2]):
+            invoice.is_frozen = True
+            invoice.save()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/charts/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.context["labels_json"]), ["2019-01-20", "2019-02-20"])
+        self.assertEqual([name for name, _ in response.context["losses_json"]],
+                         list(Product.objects.order_by("pk").values_list("name", flat=True)))
+        self.assertEqual(len([q for q in queries if "main_chartseries" in q["sql"]]), 1)
+
+        data = json.loads(self.client.get("/charts/data/").content.decode())
+        invoices = OutgoingInvoice.objects.order_by("inventory__date")
+        self.assertEqual(data["profit"], [i.profit / 100 for i in invoices])
+        beer = [s["values"] for s in data["losses"] if s["product"] == "Beer"][0]
+        self.assertEqual(beer, [abs(i.outgoinginvoiceproductposition_set.get(product=self.data.beer).loss)
+                                for i in invoices])
+
+    def test_charts_follow_changes(self):
+        for invoice in OutgoingInvoice.objects_all.all():
+            invoice.is_frozen = True
+            invoice.save()
+
+        def labels():
+            return json.loads(self.client.get("/charts/data/").content.decode())["labels"]
+
+        def products():
+            return [s["product"] for s in json.loads(self.client.get("/charts/data/").content.decode())["losses"]]
+
+        inventory = self.data.inventories[2]
+        inventory.date = datetime.date(2019, 3, 25)
+        inventory.save()
+        self.assertEqual(labels(), ["2019-01-20", "2019-02-20", "2019-03-25"])
+        OutgoingInvoice.objects.get(inventory=self.data.inventories[1]).delete()
+        self.assertEqual(labels(), ["2019-01-20", "2019-03-25"])
+        self.data.inventories[0].delete()
+        self.assertEqual(labels(), ["2019-03-25"])
+        Product.objects.create(name="Mate")
+        self.assertIn("Mate", products())
+
+    def test_conditional_get(self):
+        response = self.client.get("/inventories/")
+        etag = response["ETag"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/inventories/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # session, user and ledger version only
+        self.assertEqual(len(queries), 3)
+
+        Consumption.objects.create(date=datetime.date(2019, 2, 4), user=self.data.users[2], product=self.data.beer,
+                                   count=1, issued_by=self.data.admin)
+        response = self.client.get("/inventories/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        etag = response["ETag"]
+        BillingPeriod(self.data.inventories[1]).recalculate_temporary_invoices()
+        self.assertEqual(self.client.get("/inventories/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        # pages differ per user
+        self.data.users[0].is_staff = True
+        self.data.users[0].save()
+        etag = self.client.get("/inventories/")["ETag"]
+        self.client.force_login(self.data.users[0])
+        self.assertEqual(self.client.get("/inventories/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        # product types are shown next to the products
+        etag = self.client.get("/inventories/")["ETag"]
+        ProductType.objects.create(name="Snacks")
+        self.assertEqual(self.client.get("/inventories/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_conditional_get_csrf(self):
+        # the form of the page holds a csrf token, a new login rotates it
+        self.client.get("/invoice/2019-02-20/")
+        etag = self.client.get("/invoice/2019-02-20/")["ETag"]
+        self.assertEqual(self.client.get("/invoice/2019-02-20/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.client.logout()
+        self.client.force_login(self.data.admin)
+        response = self.client.get("/invoice/2019-02-20/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_inventory(self):
+        response = self.client.get("/inventory/2019-02-20/")
+        self.assertEqual(response.status_code, 200)
+        (_, rows), = response.context["data"]
+        bp = BillingPeriod(self.data.inventories[1])
+        for product, count, expected, loss, listed, real, _ in rows:
+            pip = ProductInPeriod(bp, product)
+            self.assertEqual(listed, pip.get_listed_consumptions())
+            self.assertEqual(real, pip.get_real_consumption())
+            self.assertEqual(loss, pip.get_loss())
+            self.assertEqual(expected, real - listed + count)
+
+    def test_new_inventory(self):
+        response = self.client.get("/inventory/")
+        self.assertEqual(response.status_code, 200)
+        (_, rows), = response.context["data"]
+        self.assertEqual([(row[0].name, row[2]) for row in rows],
+                         [("Beer", 7), ("Cola", 0), ("Juice", 2), ("Soda", 15), ("Water", 8)])
+
+    def test_inventory_unchanged_date(self):
+        periods = LedgerVersion.get_periods()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/inventory/2019-02-20/", {"date": "20.02.2019",
+                                                                   "inv-%d" % self.data.beer.pk: 3})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(ProductInventory.objects.get(inventory=self.data.inventories[1], product=self.data.beer).count,
+                         3)
+        # neither the periods nor the charts are rebuilt
+        self.assertEqual(LedgerVersion.get_periods(), periods)
+        self.assertFalse([q for q in queries if "main_chartseries" in q["sql"] or "main_consumptionrollup" in q["sql"]])
+
+    def test_inventory_queries(self):
+        with CaptureQueriesContext(connection) as before:
+            self.client.get("/inventory/2019-02-20/")
+        Product.objects.create(name="Lemonade", product_type=self.data.beer.product_type)
+        with CaptureQueriesContext(connection) as after:
+            self.client.get("/inventory/2019-02-20/")
+        self.assertEqual(len(before), len(after))
+
+    def submit(self, entries):
+        return self.client.post("/", {"json_data": json.dumps(entries)})
+
+    def test_select_product(self):
+        inventory = Inventory.objects.create(date=date_now() + datetime.timedelta(days=30))
+        DirtyProduct.objects.all().delete()
+        user0, user1 = self.data.users[:2]
+        with CaptureQueriesContext(connection) as small:
+            self.submit({user0.pk: {self.data.beer.pk: 2}})
+        with CaptureQueriesContext(connection) as large:
+            response = self.submit({user0.pk: {self.data.beer.pk: 1, self.data.soda.pk: 3},
+                                    user1.pk: {self.data.beer.pk: 4, self.data.water.pk: 1}})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(sorted(Consumption.objects.filter(date=date_now(), user=user0)
+                                .values_list("product__name", "count")), [("Beer", 1), ("Beer", 2), ("Soda", 3)])
+        self.assertEqual(set(inventory.dirtyproduct_set.values_list("product_id", flat=True)),
+                         {self.data.beer.pk, self.data.soda.pk, self.data.water.pk})
+
+    def test_select_product_invalid(self):
+        count = Consumption.objects.count()
+        self.assertEqual(self.submit({self.data.users[0].pk: {self.data.beer.pk: 1, 999: 1}}).status_code, 400)
+        self.assertEqual(self.submit({999: {self.data.beer.pk: 1}}).status_code, 400)
+        self.assertEqual(self.client.post("/", {"json_data": "{"}).status_code, 400)
+        self.assertEqual(Consumption.objects.count(), count)
+
+    def test_create_consumptions(self):
+        user0, user1 = self.data.users[:2]
+        count = Consumption.objects.count()
+        response = self.client.post("/create_consumtions/", {
+            "cons-user/-1": user0.pk, "cons-count/-1": 2, "cons-product/-1": self.data.beer.pk,
+            "cons-user/-2": user1.pk, "cons-count/-2": 1, "cons-product/-2": self.data.soda.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Consumption.objects.count(), count + 2)
+
+    def test_create_consumptions_errors(self):
+        user0 = self.data.users[0]
+        count = Consumption.objects.count()
+        response = self.client.post("/create_consumtions/", {
+            "cons-user/-1": user0.pk, "cons-count/-1": 2, "cons-product/-1": self.data.beer.pk,
+            "cons-user/-2": user0.pk, "cons-count/-2": 1, "cons-product/-2": 999,
+            "cons-user/-3": user0.pk, "cons-count/-3": "", "cons-product/-3": self.data.beer.pk,
+            "cons-user/-4": "User0", "cons-count/-4": 1, "cons-product/-4": self.data.beer.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["errors"], [("2", "unknown product"),
+                                                      ("3", "user, product and count are required"),
+                                                      ("4", "unknown user")])
+        self.assertEqual(Consumption.objects.count(), count)
+        # the submitted rows are shown again
+        rows = response.context["range"]
+        self.assertEqual((rows[0]["user_name"], rows[0]["count"], rows[0]["product_name"]),
+                         (user0.username, "2", self.data.beer.name))
+        self.assertEqual((rows[1]["product"], rows[1]["product_name"]), ("999", "999"))
+        self.assertEqual(rows[3]["user_name"], "User0")
+        self.assertNotIn("count", rows[2])
+        self.assertContains(response, 'name="cons-product/-1" id="cons-product/-1-hidden" type="text" value="%d"'
+                            % self.data.beer.pk)
+
+    def test_download_csv(self):
+        invoice = OutgoingInvoice.objects_all.get(inventory=self.data.inventories[1])
+        response = self.client.get("/invoice_csv/%d/" % invoice.pk)
+        self.assertEqual(response["Content-Disposition"], "attachment; filename=20190220.csv")
+        rows = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(rows[:4], ["Datum,20.02.2019", "Beschreibung,Getränkeabrechnung February", "",
+                                    "Account,Wert (Positiv = belastend),Notizen"])
+        self.assertEqual(sum(float(row.split(",")[1]) for row in rows[4:]), 0)
+        self.assertEqual(rows[-1], "Getränke.Erträge,%s" % (-invoice.total / 100.))
+
+    def test_download_csv_all(self):
+        def download():
+            with CaptureQueriesContext(connection) as queries:
+                content = b"".join(self.client.get("/invoice_csv/?year=2019").streaming_content).decode()
+            return content.count("Datum,"), len(queries)
+
+        OutgoingInvoice.objects_all.filter(inventory=self.data.inventories[0]).update(is_frozen=True)
+        single, single_queries = download()
+        OutgoingInvoice.objects_all.update(is_frozen=True)
+        self.assertEqual(single, 1)
+        self.assertEqual(download(), (3, single_queries))
+
+    def test_stats(self):
+        stats.reset()
+        self.client.get("/inventories/")
+        b"".join(self.client.get("/invoice_csv/?year=2019").streaming_content)
+        response = self.client.get("/stats/")
+        self.assertEqual(response.status_code, 200)
+        views = dict((entry.name, entry) for entry in response.context["views"])
+        self.assertEqual(views["admin_inventory_list"].latency.count, 1)
+        self.assertGreater(views["admin_inventory_list"].queries, 0)
+        # queries run while streaming are counted too
+        self.assertGreater(views["download_csv_all"].queries, 0)
+        self.assertTrue(response.context["slowest_queries"])
+        # the page tells which process the statistics belong to
+        self.assertContains(response, "process %d only" % os.getpid())
+
+        self.client.force_login(self.data.users[0])
+        self.assertEqual(self.client.get("/stats/").status_code, 302)